@@ -2,16 +2,24 @@ from __future__ import unicode_literals
 from django.contrib import admin
 from gametracker.models import (Game, GameReplay, GameMap, Person,
                                 Identity, EloLog)
+from gametracker.signals import deferred_elo_update
 
 
 class PersonAdmin(admin.ModelAdmin):
     exclude = ('elo', 'ngames')
 
 
+class GameAdmin(admin.ModelAdmin):
+    def delete_queryset(self, request, queryset):
+        """Update elo only once when deleting several games"""
+        with deferred_elo_update():
+            super(GameAdmin, self).delete_queryset(request, queryset)
+
+
 admin.site.site_header = ('Administration de Lan Elo Tracker')
 admin.site.index_title = ('Lan Elo Tracker')
 
-admin.site.register(Game)
+admin.site.register(Game, GameAdmin)
 admin.site.register(GameReplay)
 admin.site.register(GameMap)
 admin.site.register(Person, PersonAdmin)
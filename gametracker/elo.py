@@ -0,0 +1,247 @@
+import io
+import math
+from array import array
+from collections import namedtuple
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from gametracker.models import Game, GamePlayer, Person, EloLog, EloCheckpoint
+from gametracker.utils import team_elo_formula, elo_increment, prob_winning
+
+
+# Result of a replay: final elo and number of games of each person (indexed like EloEngine.person_ids),
+# EloLog rows as (person pk, date, elo), checkpoints as (date, {person pk: (elo, ngames)}), elo of the players
+# before and after each game (indexed like EloEngine.members) and probability of team 1 winning each game
+# (NaN if a team has no elo)
+EloResult = namedtuple('EloResult', ['elos', 'ngames', 'logs', 'checkpoints', 'elos_before', 'elos_after',
+                                     'win_probabilities'])
+
+# Columns of the GamePlayer rows built by EloEngine.game_players
+GAME_PLAYER_FIELDS = ('game_id', 'person_id', 'side', 'won', 'date', 'game_map_id', 'civilization',
+                      'elo_before', 'elo_after', 'win_probability')
+
+TEAM1 = 1
+TEAM2 = 2
+WINNERS = {"team1": TEAM1, "team2": TEAM2}
+
+# Number of rows written per query when saving ratings
+BATCH_SIZE = 1000
+
+
+class EloEngine:
+    """
+    Replay games in memory. Games are stored in compact integer arrays: the players of game 'g' are
+    members[offsets[g]:offsets[g + 1]] (indexes in person_ids), team 2 starting at members[splits[g]].
+    Game pks, maps and civilizations are only needed to build the GamePlayer rows.
+    """
+    def __init__(self, person_ids, dates, ranked, winners, offsets, splits, members,
+                 game_ids=None, maps=None, civilizations=None):
+        self.person_ids = person_ids
+        self.index = {pk: i for i, pk in enumerate(person_ids)}
+        self.dates = dates
+        self.ranked = ranked
+        self.winners = winners
+        self.offsets = offsets
+        self.splits = splits
+        self.members = members
+        self.game_ids = game_ids
+        self.maps = maps
+        self.civilizations = civilizations
+
+    def __len__(self):
+        return len(self.dates)
+
+    @classmethod
+    def from_database(cls, start=datetime.min, person_ids=None):
+        """Load all the games played from 'start' in four queries (three if person_ids are given)"""
+        if person_ids is None:
+            person_ids = Person.objects.order_by('pk').values_list('pk', flat=True)
+        person_ids = array('l', person_ids)
+        index = {pk: i for i, pk in enumerate(person_ids)}
+
+        games = list(Game.objects.filter(date__gte=start).order_by('date', 'pk')
+                                 .values_list('pk', 'date', 'ranked', 'winner', 'game_map_id'))
+        position = {game[0]: g for g, game in enumerate(games)}
+        teams = {TEAM1: [[] for game in games], TEAM2: [[] for game in games]}
+
+        for side, through in ((TEAM1, Game.team1.through), (TEAM2, Game.team2.through)):
+            rows = (through.objects.filter(game__date__gte=start, player__identity__person__isnull=False)
+                                   .order_by('pk')
+                                   .values_list('game_id', 'player__identity__person_id', 'player__civilization'))
+            for game_id, person_id, civilization in rows:
+                teams[side][position[game_id]].append((index[person_id], civilization))
+
+        offsets = array('l', [0])
+        splits = array('l')
+        members = array('l')
+        civilizations = []
+
+        for team1, team2 in zip(teams[TEAM1], teams[TEAM2]):
+            members.extend(i for i, civilization in team1)
+            splits.append(len(members))
+            members.extend(i for i, civilization in team2)
+            offsets.append(len(members))
+            civilizations.extend(civilization for i, civilization in team1 + team2)
+
+        return cls(person_ids,
+                   [game[1] for game in games],
+                   array('b', [game[2] for game in games]),
+                   array('b', [WINNERS.get(game[3], 0) for game in games]),
+                   offsets, splits, members,
+                   game_ids=array('l', [game[0] for game in games]),
+                   maps=[game[4] for game in games],
+                   civilizations=civilizations)
+
+    def run(self, elos, ngames, checkpoint_interval=None):
+        """
+        Replay all games starting from the given elo and number of games of each person.
+        A checkpoint is taken every 'checkpoint_interval' games, between two different dates.
+        """
+        elos = list(elos)
+        ngames = list(ngames)
+        logs = []
+        checkpoints = []
+
+        person_ids = self.person_ids
+        offsets = self.offsets
+        splits = self.splits
+        members = self.members
+
+        elos_before = array('l', [0]) * len(members)
+        elos_after = array('l', [0]) * len(members)
+        win_probabilities = array('d', [math.nan]) * len(self.dates)
+
+        n_games = 0
+        previous_date = None
+
+        for g, date in enumerate(self.dates):
+            if checkpoint_interval and n_games >= checkpoint_interval and date != previous_date:
+                checkpoints.append((date, {pk: (elos[i], ngames[i]) for i, pk in enumerate(person_ids)}))
+                n_games = 0
+
+            n_games += 1
+            previous_date = date
+
+            start, end = offsets[g], offsets[g + 1]
+            players = members[start:end]
+            elos_before[start:end] = array('l', [elos[i] for i in players])
+
+            team1 = members[start:splits[g]]
+            team2 = members[splits[g]:end]
+
+            # Persons without elo are not taken into account in the team elo
+            team1_elo = team_elo_formula([elos[i] for i in team1 if elos[i]])
+            team2_elo = team_elo_formula([elos[i] for i in team2 if elos[i]])
+
+            if team1_elo and team2_elo:
+                win_probabilities[g] = prob_winning(team1_elo - team2_elo)
+                if self.ranked[g]:
+                    self._play(g, date, elos, ngames, logs, team1, team2, team1_elo, team2_elo)
+
+            elos_after[start:end] = array('l', [elos[i] for i in players])
+
+        return EloResult(elos, ngames, logs, checkpoints, elos_before, elos_after, win_probabilities)
+
+    def _play(self, g, date, elos, ngames, logs, team1, team2, team1_elo, team2_elo):
+        """Update elo and number of games of the players of a ranked game"""
+        person_ids = self.person_ids
+
+        # Same variation for all the players of a team
+        delta_elo = team1_elo - team2_elo
+        increment1 = elo_increment(delta_elo, self.winners[g] == TEAM1)
+        increment2 = elo_increment(-delta_elo, self.winners[g] == TEAM2)
+
+        # A person playing in both teams is counted in team 1
+        for i in team1:
+            elos[i] = round(elos[i] + increment1)
+            logs.append((person_ids[i], date, elos[i]))
+            ngames[i] += 1
+
+        for i in team2:
+            elos[i] = round(elos[i] + (increment1 if i in team1 else increment2))
+            logs.append((person_ids[i], date, elos[i]))
+            ngames[i] += 1
+
+    def game_players(self, result):
+        """GamePlayer rows (see GAME_PLAYER_FIELDS) of all the games, built from the result of run()"""
+        for g, date in enumerate(self.dates):
+            seen = set()
+            for k in range(self.offsets[g], self.offsets[g + 1]):
+                i = self.members[k]
+
+                # A person playing twice in a game only has one result, in its first team
+                if i in seen:
+                    continue
+                seen.add(i)
+
+                side = TEAM1 if k < self.splits[g] else TEAM2
+                win_probability = result.win_probabilities[g]
+                if math.isnan(win_probability):
+                    win_probability = None
+                elif side == TEAM2:
+                    win_probability = 1 - win_probability
+
+                yield (self.game_ids[g], self.person_ids[i], side, side == self.winners[g], date, self.maps[g],
+                       self.civilizations[k], result.elos_before[k], result.elos_after[k], win_probability)
+
+
+def save_ratings(ratings, logs, checkpoints=(), game_players=(), batch_size=BATCH_SIZE):
+    """
+    Write the result of an elo calculation in a single transaction, without sending any model signal.
+    ratings: {person pk: (elo, ngames)} of the persons whose rating changed
+    logs: EloLog rows as (person pk, date, elo)
+    checkpoints: checkpoints as (date, {person pk: (elo, ngames)})
+    game_players: GamePlayer rows, see GAME_PLAYER_FIELDS
+    """
+    with transaction.atomic():
+        # Update elo and number of games with one query per batch of persons
+        ratings = list(ratings.items())
+        for i in range(0, len(ratings), batch_size):
+            batch = ratings[i:i + batch_size]
+            Person.objects.filter(pk__in=[pk for pk, rating in batch]).update(
+                elo=Case(*[When(pk=pk, then=Value(elo)) for pk, (elo, ngames) in batch],
+                         output_field=IntegerField()),
+                ngames=Case(*[When(pk=pk, then=Value(ngames)) for pk, (elo, ngames) in batch],
+                            output_field=IntegerField()))
+
+        if connection.vendor == 'postgresql':
+            _copy(EloLog, ('person_id', 'date', 'elo'), logs)
+            _copy(GamePlayer, GAME_PLAYER_FIELDS, game_players)
+        else:
+            EloLog.objects.bulk_create((EloLog(person_id=pk, date=date, elo=elo) for pk, date, elo in logs),
+                                       batch_size=batch_size)
+            GamePlayer.objects.bulk_create((GamePlayer(**dict(zip(GAME_PLAYER_FIELDS, row))) for row in game_players),
+                                           batch_size=batch_size)
+
+        elo_checkpoints = []
+        for date, checkpoint_ratings in checkpoints:
+            checkpoint = EloCheckpoint(date=date)
+            checkpoint.set_ratings(checkpoint_ratings)
+            elo_checkpoints.append(checkpoint)
+
+        EloCheckpoint.objects.bulk_create(elo_checkpoints, batch_size=batch_size)
+
+
+def _copy_value(value):
+    """Text representation of a value in a PostgreSQL COPY"""
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def _copy(model, columns, rows):
+    """Insert rows with a PostgreSQL COPY"""
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join(_copy_value(value) for value in row))
+        data.write("\n")
+    data.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert("COPY {} ({}) FROM STDIN".format(model._meta.db_table, ", ".join(columns)), data)
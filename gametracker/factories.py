@@ -47,7 +47,7 @@ class GameFactory(factory.DjangoModelFactory):
         model = models.Game
 
     date = factory.LazyFunction(timezone.now)
-    game_map = models.GameMap("")
+    game_map = None
     winner = "team1"
 
     @factory.post_generation
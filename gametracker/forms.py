@@ -5,7 +5,7 @@ from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit, Field
 
 from gametracker.models import (Game, GameMap, GameReplay,
-                                Player, Identity, Person)
+                                Player, Identity, Person, CivilizationStats)
 
 import logging
 
@@ -68,7 +68,7 @@ class ReplayForm(forms.ModelForm):
 
     class Meta:
         model = GameReplay
-        exclude = ["minimap", "speed", "difficulty"]
+        exclude = ["minimap", "speed", "difficulty", "sha256"]
 
 
 class TeamsForm(forms.Form):
@@ -76,6 +76,23 @@ class TeamsForm(forms.Form):
                                              label=_("Joueurs présents"),
                                              widget=forms.CheckboxSelectMultiple(attrs={'class': 'switch is-rounded is-success'}))
 
+    # Optional constraints on the teams, players are given by their name
+    together = forms.CharField(required=False, label=_("Joueurs ensemble"),
+                               widget=forms.TextInput(attrs={'placeholder':
+                                                             _("Joueurs ensemble (ex : Foo+Bar, Baz+Qux)")}))
+    apart = forms.CharField(required=False, label=_("Joueurs opposés"),
+                            widget=forms.TextInput(attrs={'placeholder': _("Joueurs opposés (ex : Foo+Bar)")}))
+    team1 = forms.CharField(required=False, label=_("Équipe 1"),
+                            widget=forms.TextInput(attrs={'placeholder': _("Joueurs de l'équipe 1 (ex : Foo, Bar)")}))
+    team2 = forms.CharField(required=False, label=_("Équipe 2"),
+                            widget=forms.TextInput(attrs={'placeholder': _("Joueurs de l'équipe 2 (ex : Baz)")}))
+    min_size = forms.IntegerField(required=False, min_value=1, label=_("Taille minimale des équipes"),
+                                  widget=forms.NumberInput(attrs={'placeholder': _("Taille minimale des équipes")}))
+    max_size = forms.IntegerField(required=False, min_value=1, label=_("Taille maximale des équipes"),
+                                  widget=forms.NumberInput(attrs={'placeholder': _("Taille maximale des équipes")}))
+    n_matches = forms.IntegerField(required=False, min_value=1, label=_("Nombre de parties"),
+                                   widget=forms.NumberInput(attrs={'placeholder': _("Nombre de parties simultanées")}))
+
     def __init__(self, *args, **kwargs):
         super(TeamsForm, self).__init__(*args, **kwargs)
         self.helper = FormHelper()
@@ -84,3 +101,131 @@ class TeamsForm(forms.Form):
         self.helper.label_class = 'form-label'
         self.helper.form_show_labels = False
         self.helper.add_input(Submit('submit', 'Valider', css_class="button is-success button-centered"))
+
+    def clean(self):
+        cleaned_data = super(TeamsForm, self).clean()
+        players = cleaned_data.get("players")
+        if players is None:
+            return cleaned_data
+
+        names = {player.name.lower(): player for player in players}
+
+        def find_players(field, names_list):
+            found = []
+            for name in names_list:
+                if name.strip().lower() not in names:
+                    self.add_error(field, _("Joueur inconnu ou absent : {}").format(name.strip()))
+                    return []
+                found.append(names[name.strip().lower()])
+            return found
+
+        for field in ("together", "apart"):
+            pairs = []
+            for pair in cleaned_data.get(field, "").split(","):
+                if pair.strip():
+                    pair_players = find_players(field, pair.split("+"))
+                    if len(pair_players) != 2 and field not in self.errors:
+                        self.add_error(field, _("Les joueurs doivent être donnés par paires : {}").format(pair))
+                    pairs.append(pair_players)
+            cleaned_data[field] = [tuple(pair) for pair in pairs if len(pair) == 2]
+
+        pinned = {}
+        for side, field in enumerate(("team1", "team2")):
+            for player in find_players(field, [name for name in cleaned_data.get(field, "").split(",")
+                                               if name.strip()]):
+                if pinned.get(player, side) != side:
+                    self.add_error(field, _("{} ne peut pas être dans les deux équipes").format(player))
+                pinned[player] = side
+        cleaned_data["pinned"] = pinned
+
+        n_matches = cleaned_data.get("n_matches") or 1
+        if len(players) < 2 * n_matches:
+            self.add_error("n_matches", _("Pas assez de joueurs pour {} parties").format(n_matches))
+
+        # Allowed sizes of the first team, so that both teams have between min_size and max_size players
+        min_size = cleaned_data.get("min_size") or 1
+        max_size = cleaned_data.get("max_size") or len(players)
+        cleaned_data["sizes"] = [size for size in range(1, len(players))
+                                 if min_size <= size <= max_size and min_size <= len(players) - size <= max_size]
+
+        return cleaned_data
+
+    def constraints(self):
+        """Constraints given in the form, as arguments of TeamBalancer.get_constrained_teams"""
+        data = self.cleaned_data
+        constraints = {key: data[key] for key in ("together", "apart", "pinned") if data.get(key)}
+        if data.get("min_size") or data.get("max_size"):
+            constraints["sizes"] = data["sizes"]
+        return constraints
+
+
+def civilization_choices():
+    civilizations = (Player.objects.exclude(civilization=None).order_by('civilization')
+                                   .values_list('civilization', flat=True).distinct())
+    return [("", _("Toutes les civilisations"))] + [(civilization, civilization) for civilization in civilizations]
+
+
+class HistoryFilterForm(forms.Form):
+    """Filters of the game history, given in the query string"""
+    player = forms.ModelChoiceField(queryset=Person.objects.order_by('name'), to_field_name='name',
+                                    required=False, empty_label=_("Tous les joueurs"), label=_("Joueur"))
+    game_map = forms.ModelChoiceField(queryset=GameMap.objects.order_by('name'), required=False,
+                                      empty_label=_("Toutes les cartes"), label=_("Carte"))
+    civilization = forms.ChoiceField(choices=civilization_choices, required=False, label=_("Civilisation"))
+    ranked = forms.TypedChoiceField(choices=[("", _("Classées ou non")), ("1", _("Classées")),
+                                             ("0", _("Non classées"))],
+                                    coerce=lambda value: value == "1", empty_value=None, required=False,
+                                    label=_("Classement"))
+    start = forms.DateField(required=False, label=_("Depuis le"),
+                            widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(required=False, label=_("Jusqu'au"),
+                          widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def __init__(self, *args, **kwargs):
+        super(HistoryFilterForm, self).__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_method = 'get'
+        self.helper.form_class = 'history_filters'
+        self.helper.add_input(Submit('submit', 'Filtrer', css_class="button is-info"))
+
+    def filters(self):
+        """Arguments of history.filter_games. Invalid filters are ignored"""
+        if not self.is_bound:
+            return {}
+        self.is_valid()
+        return {name: value for name, value in self.cleaned_data.items() if value not in (None, "")}
+
+
+DATETIME_INPUT_FORMATS = ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+
+class PastLeaderboardForm(forms.Form):
+    """Date of a past leaderboard, and optional date to compare the ranks with"""
+    date = forms.DateTimeField(input_formats=DATETIME_INPUT_FORMATS, label=_("Classement au"),
+                               widget=forms.DateTimeInput(attrs={'type': 'datetime-local'}))
+    since = forms.DateTimeField(input_formats=DATETIME_INPUT_FORMATS, required=False, label=_("Évolution depuis le"),
+                                widget=forms.DateTimeInput(attrs={'type': 'datetime-local'}))
+
+    def __init__(self, *args, **kwargs):
+        super(PastLeaderboardForm, self).__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_method = 'get'
+        self.helper.add_input(Submit('submit', 'Afficher', css_class="button is-info"))
+
+
+def stats_civilization_choices():
+    civilizations = CivilizationStats.objects.order_by('civilization').values_list('civilization', flat=True).distinct()
+    return [("", _("Toutes les civilisations"))] + [(civilization, civilization) for civilization in civilizations]
+
+
+class StatsForm(forms.Form):
+    """Map of the civilization statistics, and civilization to detail"""
+    game_map = forms.ModelChoiceField(queryset=GameMap.objects.order_by('name'), required=False,
+                                      empty_label=_("Toutes les cartes"), label=_("Carte"))
+    civilization = forms.ChoiceField(choices=stats_civilization_choices, required=False, label=_("Civilisation"))
+
+    def __init__(self, *args, **kwargs):
+        super(StatsForm, self).__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_method = 'get'
+        self.helper.add_input(Submit('submit', 'Afficher', css_class="button is-info"))
@@ -0,0 +1,123 @@
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+from django.db import connection
+from django.db.models import Count, IntegerField, Q, Value, Window
+from django.utils.dateparse import parse_datetime
+
+from gametracker.models import Game
+
+
+# Number of games per page of the history
+PAGE_SIZE = 50
+
+TEAM1 = 1
+TEAM2 = 2
+
+# Games of a page of the history, cursor of the next page (None if last page) and number of games matching
+# the filters (only counted for the first page)
+HistoryPage = namedtuple('HistoryPage', ['games', 'next_cursor', 'count'])
+
+
+def game_cursor(game):
+    """Position of a game in the history, most recent games first"""
+    return "{}_{}".format(game.date.isoformat(), game.pk)
+
+
+def parse_cursor(cursor):
+    """Date and pk of a cursor built by game_cursor. Raises ValueError if the cursor is invalid"""
+    date, separator, pk = cursor.rpartition("_")
+    date = parse_datetime(date)
+    if date is None:
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return date, int(pk)
+
+
+def filter_games(games, player=None, game_map=None, civilization=None, ranked=None, start=None, end=None):
+    """
+    Games played by a person, on a map, with a civilization, ranked or not, or between two dates (included).
+    Each filter is a condition on an indexed column, teams are searched with subqueries on the team tables.
+    """
+    if player is not None:
+        games = games.filter(_team_games(player__identity__person=player))
+    if civilization:
+        games = games.filter(_team_games(player__civilization=civilization))
+    if game_map is not None:
+        games = games.filter(game_map=game_map)
+    if ranked is not None:
+        games = games.filter(ranked=ranked)
+    if start is not None:
+        games = games.filter(date__gte=datetime.combine(start, time.min))
+    if end is not None:
+        games = games.filter(date__lt=datetime.combine(end + timedelta(days=1), time.min))
+
+    return games
+
+
+def _team_games(**conditions):
+    """Condition on the games with a player matching the conditions in one of their teams"""
+    return (Q(pk__in=Game.team1.through.objects.filter(**conditions).values('game_id')) |
+            Q(pk__in=Game.team2.through.objects.filter(**conditions).values('game_id')))
+
+
+def history_page(games=None, cursor=None, page_size=PAGE_SIZE):
+    """
+    A page of games, most recent first, after the given cursor. The games are located with the (date, pk)
+    of the last game of the previous page, so the cost of a page doesn't depend on its position.
+    Returns the games, with their map, replay and teams, the cursor of the next page and, for the first page,
+    the number of games, counted by the query of the page when the database supports window functions.
+    """
+    if games is None:
+        games = Game.objects.all()
+    games = games.select_related('game_map', 'replay').order_by('-date', '-pk')
+
+    count = None
+    if cursor:
+        date, pk = parse_cursor(cursor)
+        games = games.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+    elif connection.features.supports_over_clause:
+        games = games.annotate(n_games=Window(Count('pk')))
+    else:
+        count = games.count()
+
+    # One more game tells if there is a next page
+    games = list(games[:page_size + 1])
+    next_cursor = game_cursor(games[page_size - 1]) if len(games) > page_size else None
+    games = games[:page_size]
+
+    if not cursor and count is None:
+        count = games[0].n_games if games else 0
+
+    load_teams(games)
+    return HistoryPage(games, next_cursor, count)
+
+
+def load_teams(games):
+    """Set the pseudos of the winners and losers of the games, with a single query for all the games"""
+    teams = {}
+    if games:
+        game_ids = [game.pk for game in games]
+        rows = [through.objects.filter(game_id__in=game_ids)
+                               .annotate(side=Value(side, output_field=IntegerField()))
+                               .values_list('game_id', 'player_id', 'player__identity__pseudo', 'side')
+                for through, side in ((Game.team1.through, TEAM1), (Game.team2.through, TEAM2))]
+
+        # The annotation is the last column of the union
+        for game_id, player_id, pseudo, side in sorted(rows[0].union(rows[1], all=True)):
+            teams.setdefault((game_id, side), []).append(pseudo or "unknown")
+
+    for game in games:
+        winners, losers = (TEAM2, TEAM1) if game.winner == "team2" else (TEAM1, TEAM2)
+        game.winner_pseudos = teams.get((game.pk, winners), [])
+        game.loser_pseudos = teams.get((game.pk, losers), [])
+
+
+def game_data(game):
+    """Description of a game of the history, for the JSON endpoint"""
+    return {'pk': game.pk,
+            'date': game.date.isoformat(),
+            'map': game.game_map.name if game.game_map else None,
+            'minimap': game.replay.minimap.url if game.replay and game.replay.minimap else None,
+            'ranked': game.ranked,
+            'winners': game.winner_pseudos,
+            'losers': game.loser_pseudos}
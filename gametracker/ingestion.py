@@ -0,0 +1,309 @@
+import re
+import os
+import logging
+import traceback
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+
+from gametracker.models import Game, GameReplay, GameMap, Player, Identity, ReplayJob
+from gametracker.parsers import replay_parser
+from gametracker.replay_cache import replay_cache
+from gametracker.signals import update_elo
+from gametracker.stats import add_game
+
+
+logger = logging.getLogger(__name__)
+
+# Time after which a running job is considered abandoned by its worker, much longer than the parser timeout
+STALE_JOB_TIMEOUT = timedelta(minutes=15)
+
+
+def parse_replay(replay):
+    """Run the replay analyzer. Returns the game data and the paths of the minimap and chronology images"""
+    return parse_replay_file(replay.replay.path, replay.sha256)
+
+
+def parse_replay_file(path, sha256=None):
+    """
+    Parse a replay file with the parser service. If the SHA-256 of the file is given,
+    the result of a previous parsing is taken from the replay cache.
+    """
+    basename = os.path.splitext(os.path.basename(path))[0]
+    minimap_path = '/minimaps/' + basename + '.png'
+    chronology_path = '/researches/' + basename + '.png'
+    minimap_file = settings.MEDIA_ROOT + minimap_path
+    chronology_file = settings.MEDIA_ROOT + chronology_path
+
+    cache = replay_cache() if sha256 else None
+    game_data = cache.get(sha256, minimap_file, chronology_file) if cache else None
+
+    if game_data is None:
+        game_data = replay_parser().parse(path, minimap_file, chronology_file)
+        if cache:
+            cache.put(sha256, game_data, minimap_file, chronology_file)
+
+    return game_data, minimap_path, chronology_path
+
+
+def replay_date(path):
+    """Parse date in filename"""
+    reg = None
+
+    # AOE2HD style
+    if path.endswith(".aoe2record"):
+        reg = re.search("([0-9]{4})\.([0-9]{2})\.([0-9]{2}).([0-9]{2})([0-9]{2})([0-9]{2})", path)
+    # AoFE style
+    elif path.endswith(".mgz"):
+        reg = re.search("([0-9]{4})(0[1-9]|1[0-2])([0-9]{2})-([0-9]{2})([0-9]{2})([0-9]{2})", path)
+
+    if reg:
+        strdate = (reg.group(1) + "-" + reg.group(2) + "-" + reg.group(3) + " " +
+                   reg.group(4) + ":" + reg.group(5) + ":" + reg.group(6))
+        return datetime.strptime(strdate, "%Y-%m-%d %H:%M:%S")
+
+    return timezone.now()
+
+
+def _bulk_insert(model, objs):
+    """
+    Insert objects with a single query and set their primary key. PostgreSQL returns the keys of the
+    inserted rows. In a transaction, SQLite locks the whole database for writing, so the inserted rows
+    are the last ones. Other backends insert the objects one by one.
+    """
+    if connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+
+    if connection.vendor == 'sqlite' and connection.in_atomic_block:
+        model.objects.bulk_create(objs)
+        pks = list(model.objects.order_by('-pk').values_list('pk', flat=True)[:len(objs)])
+        for obj, pk in zip(objs, reversed(pks)):
+            obj.pk = pk
+        return objs
+
+    for obj in objs:
+        obj.save()
+    return objs
+
+
+def resolve_identities(pseudos):
+    """Returns a dictionary pseudo -> identity, creating the missing identities. Two queries at most"""
+    pseudos = set(pseudos)
+    identities = {}
+
+    # The oldest identity is used if a pseudo has several ones
+    for identity in Identity.objects.filter(pseudo__in=pseudos).order_by('-pk'):
+        identities[identity.pseudo] = identity
+
+    missing = [Identity(pseudo=pseudo) for pseudo in sorted(pseudos) if pseudo not in identities]
+    for identity in _bulk_insert(Identity, missing):
+        identities[identity.pseudo] = identity
+
+    return identities
+
+
+def save_game(replay, game_data, date, minimap_path, chronology_path):
+    """
+    Add the game described by the analyzer output, with the same number of queries whatever the number
+    of players. Returns the game and whether it was created (False if the game was already in the database).
+    Elo is not updated.
+    """
+    game_map, created = GameMap.objects.get_or_create(name=game_data["map"])
+
+    # Nothing is added for games already in the database
+    game = Game.objects.filter(date=date, game_map=game_map).first()
+    if game is not None:
+        logger.warning("La partie existe déjà dans la base de données...")
+        return game, False
+
+    with transaction.atomic():
+        # Add information to replay
+        GameReplay.objects.filter(pk=replay.pk).update(game_version=game_data["version"],
+                                                      game_type=game_data["type"],
+                                                      speed=game_data["speed"],
+                                                      difficulty=game_data["difficulty"],
+                                                      population_limit=game_data["population_limit"],
+                                                      minimap=minimap_path,
+                                                      chronology=chronology_path)
+
+        identities = resolve_identities(game_data["players"])
+
+        # Create teams
+        teams = {}
+        n_resign = {}
+        players = []
+        for number, (player_name, player_stats) in enumerate(game_data["players"].items(), 1):
+            p = Player(identity=identities[player_name],
+                       number=number,
+                       civilization=player_stats["civilization"],
+                       resign_time=player_stats["resign_time"],
+                       team=player_stats["team"] if player_stats["team"] >= 0 else None)
+
+            players.append(p)
+            teams.setdefault(p.team, []).append(p)
+
+            # Count the number of resigns in each team
+            n_resign[p.team] = n_resign.get(p.team, 0) + int(p.resign_time > 0)
+
+        _bulk_insert(Player, players)
+
+        # The winning team is the team with the lowest number of resigns
+        winning_team = min(n_resign, key=n_resign.get)
+
+        # Create a game with all the players
+        game = Game(date=date, game_map=game_map, ranked=False, replay_id=replay.pk)
+
+        sides = sorted(teams.keys())
+        if len(sides) == 2:
+            game.ranked = True
+            if winning_team == sides[0]:
+                game.winner = "team1"
+            elif winning_team == sides[1]:
+                game.winner = "team2"
+
+        game.save()
+
+        if game.ranked:
+            for through, side in ((Game.team1.through, sides[0]), (Game.team2.through, sides[1])):
+                through.objects.bulk_create([through(game_id=game.pk, player_id=p.pk) for p in teams[side]])
+
+            winners, losers = (sides[1], sides[0]) if game.winner == "team2" else (sides[0], sides[1])
+            add_game(game, [p.civilization for p in teams[winners]], [p.civilization for p in teams[losers]])
+
+    return game, True
+
+
+def analyze_replay(replay):
+    """
+    Parse a replay and add the corresponding game. Returns the game and whether it was created.
+    The replay is deleted if the game was already in the database.
+    """
+    game_data, minimap_path, chronology_path = parse_replay(replay)
+
+    # The parser can run for a long time: only the database writes are done in a transaction
+    with transaction.atomic():
+        game, created = save_game(replay, game_data, replay_date(replay.replay.path), minimap_path, chronology_path)
+
+        if not created:
+            # Also delete the images generated by the analyzer, unless they belong to another replay
+            if not GameReplay.objects.filter(minimap=minimap_path).exists():
+                replay.minimap = minimap_path
+                replay.chronology = chronology_path
+            replay.delete()
+
+    return game, created
+
+
+def claim_jobs(n_jobs):
+    """
+    Mark at most 'n_jobs' pending jobs as running and return their ids. Jobs running for more than
+    STALE_JOB_TIMEOUT were left by a worker which died or was restarted, they are pending again.
+    """
+    ReplayJob.objects.filter(status=ReplayJob.RUNNING, started__lt=timezone.now() - STALE_JOB_TIMEOUT) \
+                     .update(status=ReplayJob.PENDING, started=None)
+
+    with transaction.atomic():
+        jobs = ReplayJob.objects.filter(status=ReplayJob.PENDING).order_by('created')
+
+        # Several workers can run at the same time
+        if connection.features.has_select_for_update_skip_locked:
+            jobs = jobs.select_for_update(skip_locked=True)
+
+        job_ids = list(jobs.values_list('pk', flat=True)[:n_jobs])
+        ReplayJob.objects.filter(pk__in=job_ids).update(status=ReplayJob.RUNNING, started=timezone.now())
+
+    return job_ids
+
+
+def run_job(job_id):
+    """Analyze the replay of a job. Returns the date of the new game, or None if no game was created"""
+    job = ReplayJob.objects.select_related('replay').get(pk=job_id)
+
+    try:
+        game, created = analyze_replay(job.replay)
+    except Exception:
+        logger.exception("Can't analyze replay %s", job.replay)
+        ReplayJob.objects.filter(pk=job_id).update(status=ReplayJob.FAILED, error=traceback.format_exc(),
+                                                   finished=timezone.now())
+        return None
+
+    ReplayJob.objects.filter(pk=job_id).update(status=ReplayJob.DONE if created else ReplayJob.DUPLICATE,
+                                               game=game, finished=timezone.now())
+    return game.date if created else None
+
+
+def process_jobs(n_jobs, pool=None):
+    """
+    Run at most 'n_jobs' pending jobs, in parallel if a pool of threads is given,
+    then update elo once for all the new games. Returns the number of jobs run.
+    """
+    job_ids = claim_jobs(n_jobs)
+    if not job_ids:
+        return 0
+
+    if pool is None:
+        dates = [run_job(job_id) for job_id in job_ids]
+    else:
+        dates = pool.map(run_job, job_ids)
+
+    dates = [date for date in dates if date is not None]
+    if dates:
+        update_elo(min(dates))
+
+    return len(job_ids)
+
+
+def import_replay_files(parsed):
+    """
+    Add games from replay files already parsed with parse_replay_file, in a single transaction.
+    'parsed' is a list of (path, SHA-256, game data, minimap path, chronology path).
+    Returns the games created and the number of duplicated games. Elo is not updated.
+    """
+    parsed = [(path, sha256, replay_date(path), game_data, minimap_path, chronology_path)
+              for path, sha256, game_data, minimap_path, chronology_path in parsed]
+
+    # Skip games already in the database, or twice in the batch, before copying their replay
+    known = set(Game.objects.filter(date__in=[replay[2] for replay in parsed])
+                            .values_list('date', 'game_map__name'))
+    known_hashes = set(GameReplay.objects.filter(sha256__in=[replay[1] for replay in parsed])
+                                         .values_list('sha256', flat=True))
+    new_replays = []
+    for replay in parsed:
+        key = (replay[2], replay[3]["map"])
+        if key not in known and replay[1] not in known_hashes:
+            known.add(key)
+            known_hashes.add(replay[1])
+            new_replays.append(replay)
+
+    games = []
+    storage = GameReplay._meta.get_field('replay').storage
+    names = []
+    try:
+        with transaction.atomic():
+            # Store all the replays at once, without sending them to the analysis queue
+            for path, sha256, date, game_data, minimap_path, chronology_path in new_replays:
+                with open(path, 'rb') as replay_file:
+                    names.append(storage.save('games/' + os.path.basename(path), File(replay_file)))
+
+            GameReplay.objects.bulk_create([GameReplay(replay=name, sha256=replay[1])
+                                            for name, replay in zip(names, new_replays)])
+            replays = {replay.replay.name: replay for replay in GameReplay.objects.filter(replay__in=names)}
+
+            for name, (path, sha256, date, game_data, minimap_path, chronology_path) in zip(names, new_replays):
+                game, created = save_game(replays[name], game_data, date, minimap_path, chronology_path)
+
+                # The game may have been added since the games were filtered (by a replay worker for instance)
+                if created:
+                    games.append(game)
+                else:
+                    replays[name].delete()
+    except Exception:
+        # The files are not removed by the rollback
+        for name in names:
+            storage.delete(name)
+        raise
+
+    return games, len(parsed) - len(games)
@@ -0,0 +1,62 @@
+from collections import namedtuple
+from datetime import datetime
+
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q
+
+from gametracker.models import EloLog
+
+
+# Position of a person in a past leaderboard, and date of its last game
+Standing = namedtuple('Standing', ['rank', 'person', 'elo', 'date'])
+
+# Position of a person at the end of a period, and at its beginning (None if the person had not played yet)
+RankMovement = namedtuple('RankMovement', ['rank', 'person', 'elo', 'previous_rank', 'previous_elo', 'movement'])
+
+
+def latest_logs(date):
+    """
+    Latest EloLog of each person at or before 'date', with the person, in a single query on the (person, date)
+    index. PostgreSQL keeps the first log of each person with DISTINCT ON, other databases keep the logs
+    which have no later log of the same person.
+    """
+    logs = EloLog.objects.filter(date__lte=date).select_related('person')
+
+    if connection.vendor == 'postgresql':
+        return logs.order_by('person_id', '-date', '-pk').distinct('person_id')
+
+    later = EloLog.objects.filter(Q(date__gt=OuterRef('date')) | Q(date=OuterRef('date'), pk__gt=OuterRef('pk')),
+                                  person_id=OuterRef('person_id'), date__lte=date)
+    return logs.annotate(superseded=Exists(later)).filter(superseded=False)
+
+
+def leaderboard_at(date):
+    """
+    Leaderboard after the games played up to 'date', best first. Persons who had not played any game
+    at that date are not ranked. Persons with the same elo have the same rank.
+    """
+    logs = sorted((log for log in latest_logs(date) if log.date != datetime.min),
+                  key=lambda log: (-log.elo, log.person.name.lower()))
+
+    standings = []
+    for position, log in enumerate(logs, 1):
+        rank = standings[-1].rank if standings and standings[-1].elo == log.elo else position
+        standings.append(Standing(rank, log.person, log.elo, log.date))
+
+    return standings
+
+
+def rank_movements(start, end):
+    """Leaderboard at 'end', with the rank and elo of each person at 'start' and the number of ranks gained"""
+    previous = {standing.person.pk: standing for standing in leaderboard_at(start)}
+
+    movements = []
+    for standing in leaderboard_at(end):
+        before = previous.get(standing.person.pk)
+        if before is None:
+            movements.append(RankMovement(standing.rank, standing.person, standing.elo, None, None, None))
+        else:
+            movements.append(RankMovement(standing.rank, standing.person, standing.elo, before.rank, before.elo,
+                                          before.rank - standing.rank))
+
+    return movements
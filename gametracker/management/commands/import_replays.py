@@ -0,0 +1,98 @@
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from gametracker.ingestion import parse_replay_file, import_replay_files
+from gametracker.models import GameReplay
+from gametracker.parsers import replay_parser
+from gametracker.signals import update_elo
+from gametracker.uploadhandlers import sha256sum
+
+
+REPLAY_EXTENSIONS = (".mgz", ".aoe2record")
+
+
+def parse(replay):
+    """Parse a replay file (or take it from the cache). Returns the replay and the parsing result, or the error"""
+    try:
+        return replay, parse_replay_file(*replay), None
+    except Exception as e:
+        return replay, None, "{}: {}".format(type(e).__name__, e)
+
+
+class Command(BaseCommand):
+    help = "Import all the replays of a directory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of replays parsed at the same time (defaults to the number of parser processes)")
+        parser.add_argument('--batch', type=int, default=100,
+                            help="Number of games added per transaction")
+
+    def handle(self, *args, **options):
+        paths = sorted(os.path.join(root, filename)
+                       for root, dirs, filenames in os.walk(options['directory'])
+                       for filename in filenames if filename.endswith(REPLAY_EXTENSIONS))
+
+        self.stdout.write("{} replay(s) found".format(len(paths)))
+        start = time.time()
+
+        n_games, n_duplicates = 0, 0
+        failures = []
+        first_date = None
+
+        # Replays already in the database are not parsed
+        hashes = {}
+        for path in paths:
+            with open(path, 'rb') as replay_file:
+                hashes.setdefault(sha256sum(replay_file), path)
+
+        known_hashes = set(GameReplay.objects.filter(sha256__in=hashes).values_list('sha256', flat=True))
+        replays = sorted((path, sha256) for sha256, path in hashes.items() if sha256 not in known_hashes)
+        n_duplicates = len(paths) - len(replays)
+
+        # Start the parser processes before any thread
+        replay_parser()
+
+        workers = options['workers'] or getattr(settings, 'GAMETRACKER_REPLAY_PARSER', {}).get('WORKERS', 2)
+
+        with ThreadPool(max(1, workers)) as pool:
+            batch = []
+            results = pool.imap_unordered(parse, replays, chunksize=4)
+
+            for i, (replay, result, error) in enumerate(results, 1):
+                if error:
+                    failures.append((replay[0], error))
+                else:
+                    batch.append(tuple(replay) + tuple(result))
+
+                if len(batch) >= options['batch'] or (i == len(replays) and batch):
+                    try:
+                        games, duplicates = import_replay_files(batch)
+                    except Exception as e:
+                        failures.extend((replay[0], "{}: {}".format(type(e).__name__, e)) for replay in batch)
+                    else:
+                        n_games += len(games)
+                        n_duplicates += duplicates
+                        dates = [game.date for game in games]
+                        if dates and (first_date is None or min(dates) < first_date):
+                            first_date = min(dates)
+                    batch = []
+
+                    self.stdout.write("{}/{} replay(s) processed".format(i, len(replays)))
+
+        # A single elo update for all the imported games
+        if first_date is not None:
+            update_elo(first_date)
+
+        elapsed = time.time() - start
+        self.stdout.write(self.style.SUCCESS(
+            "{} game(s) imported, {} duplicate(s), {} failure(s) in {:.1f}s ({:.1f} replays/s)".format(
+                n_games, n_duplicates, len(failures), elapsed, len(paths) / elapsed if elapsed else 0)))
+
+        for path, error in failures:
+            self.stderr.write("{}: {}".format(path, error))
@@ -0,0 +1,51 @@
+import time
+
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from gametracker.ingestion import process_jobs
+from gametracker.parsers import replay_parser
+
+
+class Command(BaseCommand):
+    help = "Analyze the uploaded replays waiting in the queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of replays analyzed at the same time "
+                                 "(defaults to the number of parser processes, 0 to analyze them one by one)")
+        parser.add_argument('--batch', type=int, default=None,
+                            help="Maximum number of replays analyzed before updating elo")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true',
+                            help="Stop when the queue is empty")
+
+    def handle(self, *args, **options):
+        # Start the parser processes before any thread
+        replay_parser()
+
+        workers = options['workers']
+        if workers is None:
+            workers = getattr(settings, 'GAMETRACKER_REPLAY_PARSER', {}).get('WORKERS', 2)
+
+        batch = options['batch'] or max(1, 4 * workers)
+        pool = ThreadPool(workers) if workers > 0 else None
+
+        try:
+            while True:
+                n_jobs = process_jobs(batch, pool)
+
+                if n_jobs:
+                    self.stdout.write("{} replay(s) analyzed".format(n_jobs))
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
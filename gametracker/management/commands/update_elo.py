@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from gametracker.models import EloCheckpoint
+from gametracker.signals import update_elo
+
+
+class Command(BaseCommand):
+    help = "Recalculate elo and game results from the first game"
+
+    def handle(self, *args, **options):
+        EloCheckpoint.objects.all().delete()
+        update_elo()
+        self.stdout.write(self.style.SUCCESS("Elo updated"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from gametracker.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = "Recalculate the civilization and map statistics from all the ranked games"
+
+    def handle(self, *args, **options):
+        rebuild_stats()
+        self.stdout.write(self.style.SUCCESS("Statistics updated"))
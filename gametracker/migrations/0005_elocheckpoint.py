@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0004_auto_20181015_1431'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EloCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(db_index=True)),
+                ('ratings', models.TextField(default='{}')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0005_elocheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplayJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('running', 'En cours'), ('done', 'Terminé'), ('duplicate', 'Partie dupliquée'), ('failed', 'Erreur')], db_index=True, default='pending', max_length=20)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('started', models.DateTimeField(blank=True, default=None, null=True)),
+                ('finished', models.DateTimeField(blank=True, default=None, null=True)),
+                ('game', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='gametracker.Game')),
+                ('replay', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gametracker.GameReplay')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0006_replayjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamereplay',
+            name='sha256',
+            field=models.CharField(blank=True, default=None, max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='replayjob',
+            name='replay',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='gametracker.GameReplay'),
+        ),
+    ]
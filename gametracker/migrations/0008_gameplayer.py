@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def delete_checkpoints(apps, schema_editor):
+    """Without checkpoints, the next elo update fills GamePlayer for all the games"""
+    apps.get_model('gametracker', 'EloCheckpoint').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0007_auto_20261018_0413'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GamePlayer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('side', models.PositiveSmallIntegerField(choices=[(1, 'Équipe 1'), (2, 'Équipe 2')])),
+                ('won', models.BooleanField(default=False)),
+                ('date', models.DateTimeField()),
+                ('civilization', models.CharField(blank=True, default=None, max_length=50, null=True)),
+                ('elo_before', models.PositiveIntegerField(default=0)),
+                ('elo_after', models.PositiveIntegerField(default=0)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gametracker.Game')),
+                ('game_map', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='gametracker.GameMap')),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gametracker.Person')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gameplayer',
+            index=models.Index(fields=['person', 'date'], name='gametracker_person__247f42_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='gameplayer',
+            unique_together={('game', 'person')},
+        ),
+        migrations.RunPython(delete_checkpoints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0008_gameplayer'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['ranked', 'date'], name='gametracker_ranked_0d9a1e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['game_map', 'date'], name='gametracker_game_ma_d78473_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['civilization'], name='gametracker_civiliz_1188b9_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:42
+
+from django.db import migrations, models
+
+
+def delete_checkpoints(apps, schema_editor):
+    """Without checkpoints, the next elo update fills the win probability for all the games"""
+    apps.get_model('gametracker', 'EloCheckpoint').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0009_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayer',
+            name='win_probability',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.RunPython(delete_checkpoints, migrations.RunPython.noop),
+    ]
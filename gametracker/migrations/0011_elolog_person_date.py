@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0010_gameplayer_win_probability'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='elolog',
+            index=models.Index(fields=['person', 'date'], name='gametracker_person__dff28c_idx'),
+        ),
+    ]
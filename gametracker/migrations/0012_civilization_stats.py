@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-18 04:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0011_elolog_person_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CivilizationMatchup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('civilization', models.CharField(max_length=50)),
+                ('opponent', models.CharField(max_length=50)),
+                ('games', models.PositiveIntegerField(default=0)),
+                ('wins', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('civilization', 'opponent')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CivilizationStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('civilization', models.CharField(max_length=50)),
+                ('games', models.PositiveIntegerField(default=0)),
+                ('wins', models.PositiveIntegerField(default=0)),
+                ('game_map', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='gametracker.GameMap')),
+            ],
+            options={
+                'unique_together': {('civilization', 'game_map')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0012_civilization_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField(default=0)),
+                ('modified', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 05:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gametracker', '0013_ratinggeneration'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='civilizationstats',
+            constraint=models.UniqueConstraint(condition=models.Q(game_map=None), fields=('civilization',), name='unique_civilization_without_map'),
+        ),
+    ]
@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import json
+
 from django.db import models
 
 
@@ -40,6 +42,10 @@ class Player(models.Model):
     civilization = models.CharField(max_length=50, default=None, null=True, blank=True)
     resign_time = models.PositiveIntegerField(default=0, blank=True)
 
+    class Meta:
+        # Filter of the game history by civilization
+        indexes = [models.Index(fields=['civilization'])]
+
     def __str__(self):
         if self.identity:
             return self.identity.pseudo
@@ -76,6 +82,11 @@ class Game(models.Model):
                                                                        ("team2", "Équipe 2")])
     replay = models.ForeignKey('GameReplay', on_delete=models.PROTECT, null=True, blank=True)
 
+    class Meta:
+        # Filters of the game history, sorted by date
+        indexes = [models.Index(fields=['ranked', 'date']),
+                   models.Index(fields=['game_map', 'date'])]
+
     def __str__(self):
         return str(self.date)
 
@@ -98,9 +109,39 @@ class Game(models.Model):
             return self.team2.all()
 
 
+class GamePlayer(models.Model):
+    """
+    Result of a person in a game, denormalized from Game, Player and EloLog for the per-person queries,
+    with the probability of winning the game before it was played. Rebuilt by update_elo for all the games
+    it replays.
+    """
+    game = models.ForeignKey('Game', on_delete=models.CASCADE)
+    person = models.ForeignKey('Person', on_delete=models.CASCADE)
+    side = models.PositiveSmallIntegerField(choices=[(1, "Équipe 1"), (2, "Équipe 2")])
+    won = models.BooleanField(default=False)
+    date = models.DateTimeField()
+    game_map = models.ForeignKey('GameMap', on_delete=models.SET_NULL, null=True, blank=True)
+    civilization = models.CharField(max_length=50, default=None, null=True, blank=True)
+    elo_before = models.PositiveIntegerField(default=0)
+    elo_after = models.PositiveIntegerField(default=0)
+    win_probability = models.FloatField(default=None, null=True, blank=True)
+
+    class Meta:
+        unique_together = ('game', 'person')
+        indexes = [models.Index(fields=['person', 'date'])]
+
+    def __str__(self):
+        return str(self.person) + " " + str(self.game)
+
+    @property
+    def elo_delta(self):
+        return self.elo_after - self.elo_before
+
+
 class GameReplay(models.Model):
     """Replay of a game"""
     replay = models.FileField(upload_to='games/')
+    sha256 = models.CharField(max_length=64, default=None, null=True, blank=True, unique=True)
 
     minimap = models.ImageField(upload_to='minimaps/', default='', blank=True)
     chronology = models.ImageField(upload_to='researches/', default='', blank=True)
@@ -121,5 +162,111 @@ class EloLog(models.Model):
     date = models.DateTimeField(db_index=True)
     elo = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        # Latest elo of each person at a given date
+        indexes = [models.Index(fields=['person', 'date'])]
+
     def __str__(self):
         return str(self.person) + " " + self.date.strftime("%Y-%m-%d %H:%M:%S") + ' ' + str(self.elo)
+
+
+class EloCheckpoint(models.Model):
+    """
+    Snapshot of the elo and number of games of all persons, taken before the games played at 'date'.
+    Used by update_elo to restart the calculation without replaying the whole history.
+    """
+    date = models.DateTimeField(db_index=True)
+    ratings = models.TextField(default="{}")
+
+    def __str__(self):
+        return self.date.strftime("%Y-%m-%d %H:%M:%S")
+
+    def get_ratings(self):
+        """Returns a dictionary person pk -> (elo, ngames)"""
+        return {int(pk): tuple(values) for pk, values in json.loads(self.ratings).items()}
+
+    def set_ratings(self, ratings):
+        """Store a dictionary person pk -> (elo, ngames)"""
+        self.ratings = json.dumps({str(pk): list(values) for pk, values in ratings.items()})
+
+
+class RatingGeneration(models.Model):
+    """
+    Single row counting the rating changes, incremented in the transaction of each change. Everything computed
+    from the ratings (snapshots, cached leaderboard and team balancing) is keyed by this counter, which is
+    shared by the web processes and the replay workers through the database.
+    """
+    generation = models.BigIntegerField(default=0)
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return "{} ({})".format(self.generation, self.modified)
+
+
+class ReplayJob(models.Model):
+    """A replay waiting to be analyzed by a replay worker"""
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+
+    replay = models.ForeignKey('GameReplay', on_delete=models.SET_NULL, default=None, null=True, blank=True)
+    game = models.ForeignKey('Game', on_delete=models.SET_NULL, default=None, null=True, blank=True)
+    status = models.CharField(max_length=20, default=PENDING, db_index=True,
+                              choices=[(PENDING, "En attente"), (RUNNING, "En cours"), (DONE, "Terminé"),
+                                       (DUPLICATE, "Partie dupliquée"), (FAILED, "Erreur")])
+    error = models.TextField(default="", blank=True)
+
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    started = models.DateTimeField(default=None, null=True, blank=True)
+    finished = models.DateTimeField(default=None, null=True, blank=True)
+
+    def __str__(self):
+        return "{} ({})".format(self.replay, self.status)
+
+    def is_finished(self):
+        return self.status in (self.DONE, self.DUPLICATE, self.FAILED)
+
+
+class CivilizationStats(models.Model):
+    """
+    Number of games played and won with a civilization on a map, over all the ranked games.
+    Updated when games are added or deleted, rebuilt by the 'update_stats' command.
+    """
+    civilization = models.CharField(max_length=50)
+    game_map = models.ForeignKey('GameMap', on_delete=models.CASCADE, null=True, blank=True)
+    games = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('civilization', 'game_map')
+        # NULL maps are not equal in the unique constraint above
+        constraints = [models.UniqueConstraint(fields=['civilization'], condition=models.Q(game_map=None),
+                                               name='unique_civilization_without_map')]
+
+    def __str__(self):
+        return "{} ({}): {}/{}".format(self.civilization, self.game_map, self.wins, self.games)
+
+    def win_ratio(self):
+        return self.wins * 100.0 / self.games if self.games else 0
+
+
+class CivilizationMatchup(models.Model):
+    """
+    Number of times a civilization played against another one, and won, over all the ranked games.
+    Each pair of opponents is counted once in each direction.
+    """
+    civilization = models.CharField(max_length=50)
+    opponent = models.CharField(max_length=50)
+    games = models.PositiveIntegerField(default=0)
+    wins = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('civilization', 'opponent')
+
+    def __str__(self):
+        return "{} vs. {}: {}/{}".format(self.civilization, self.opponent, self.wins, self.games)
+
+    def win_ratio(self):
+        return self.wins * 100.0 / self.games if self.games else 0
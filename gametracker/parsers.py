@@ -0,0 +1,181 @@
+import io
+import sys
+import json
+import queue
+import logging
+import threading
+import traceback
+import subprocess
+import multiprocessing
+
+from contextlib import redirect_stdout
+import django
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+ANALYZER_SCRIPT = "/home/yoann/software/pyrecanalyst/examples/analyze.py"
+
+
+class ReplayParserError(Exception):
+    """The replay could not be parsed"""
+
+
+class ReplayParserTimeout(ReplayParserError):
+    """The parsing took too long"""
+
+
+class ReplayParser:
+    """
+    Parsing backend. parse() must return the game data (version, type, speed, difficulty,
+    population_limit, map and players) and write the minimap and chronology images.
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def parse(self, path, minimap_file, chronology_file):
+        raise NotImplementedError
+
+
+class ScriptParser(ReplayParser):
+    """Run the analyzer script in a new process for each replay"""
+    def parse(self, path, minimap_file, chronology_file):
+        cmd = [self.options.get('script', ANALYZER_SCRIPT), "-i", path, "-l", "fr",
+               "-m", minimap_file, "-r", chronology_file]
+
+        logger.debug(cmd)
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        logger.debug(p.stderr)
+
+        return json.loads(p.stdout.decode('utf-8', errors='ignore').replace('\n', ''))
+
+
+class PyRecAnalystParser(ReplayParser):
+    """Run the analyzer script in the current interpreter, so that its modules are only imported once"""
+    def __init__(self, **options):
+        super(PyRecAnalystParser, self).__init__(**options)
+        self.script = self.options.get('script', ANALYZER_SCRIPT)
+
+        with open(self.script) as f:
+            self.code = compile(f.read(), self.script, 'exec')
+
+    def parse(self, path, minimap_file, chronology_file):
+        argv = sys.argv
+        out = io.StringIO()
+        sys.argv = [self.script, "-i", path, "-l", "fr", "-m", minimap_file, "-r", chronology_file]
+
+        try:
+            with redirect_stdout(out):
+                exec(self.code, {'__name__': '__main__', '__file__': self.script})
+        except SystemExit as e:
+            if e.code:
+                raise ReplayParserError("Analyzer exited with code {}".format(e.code))
+        finally:
+            sys.argv = argv
+
+        return json.loads(out.getvalue().replace('\n', ''))
+
+
+def _worker_main(conn, backend, options):
+    """Parse the replays received through the pipe until it is closed"""
+    # The process is started by the fork server, not forked from the Django process
+    django.setup()
+    parser = import_string(backend)(**options)
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            conn.send((True, parser.parse(*request)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+
+class ParserWorker:
+    """
+    A process running a parsing backend, receiving requests through a pipe. Workers are replaced from the
+    threads of the replay workers: they are started by a fork server, since forking a process with several
+    threads could copy locks held by the other threads (logging, database connection...).
+    """
+    def __init__(self, backend, options):
+        context = multiprocessing.get_context('forkserver')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, backend, options), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def parse(self, request, timeout):
+        self.conn.send(request)
+
+        if not self.conn.poll(timeout):
+            raise ReplayParserTimeout("Timeout after {}s".format(timeout))
+
+        success, result = self.conn.recv()
+        if not success:
+            raise ReplayParserError(result)
+        return result
+
+    def stop(self):
+        self.conn.close()
+        self.process.kill()
+        self.process.join()
+
+
+class ParserService:
+    """
+    Pool of long-lived parsing processes. Each replay is parsed by an idle worker. A worker which crashes
+    or exceeds the timeout is replaced, without affecting the other replays.
+    """
+    def __init__(self, backend='gametracker.parsers.PyRecAnalystParser', workers=2, timeout=120, options=None):
+        self.backend = backend
+        self.options = options or {}
+        self.timeout = timeout
+        self.idle = queue.Queue()
+
+        for i in range(workers):
+            self.idle.put(ParserWorker(self.backend, self.options))
+
+    def parse(self, path, minimap_file, chronology_file, timeout=None):
+        """Parse a replay file. Raises ReplayParserError if the parsing failed"""
+        worker = self.idle.get()
+
+        try:
+            return worker.parse((path, minimap_file, chronology_file), timeout or self.timeout)
+        except ReplayParserTimeout:
+            # The worker may be stuck: replace it
+            worker.stop()
+            worker = ParserWorker(self.backend, self.options)
+            raise
+        except (EOFError, OSError):
+            worker.stop()
+            worker = ParserWorker(self.backend, self.options)
+            raise ReplayParserError("Parser crashed while parsing {}".format(path))
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().stop()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def replay_parser():
+    """Parser service of the current process, configured by the GAMETRACKER_REPLAY_PARSER setting"""
+    global _service
+
+    with _service_lock:
+        if _service is None:
+            config = getattr(settings, 'GAMETRACKER_REPLAY_PARSER', {})
+            _service = ParserService(backend=config.get('BACKEND', 'gametracker.parsers.PyRecAnalystParser'),
+                                     workers=config.get('WORKERS', 2),
+                                     timeout=config.get('TIMEOUT', 120),
+                                     options=config.get('OPTIONS'))
+    return _service
@@ -0,0 +1,213 @@
+import time
+import bisect
+import hashlib
+import threading
+
+from array import array
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from gametracker.models import Person, Player, RatingGeneration
+
+
+# Primary key of the RatingGeneration row
+GENERATION_PK = 1
+
+
+def rating_state():
+    """
+    Rating generation and time of the last rating change (in UTC), read with a single query. The generation
+    is stored in the database, so that rating changes made by any process (a replay worker for instance)
+    are seen by all the others.
+    """
+    state = RatingGeneration.objects.filter(pk=GENERATION_PK).values_list('generation', 'modified').first()
+    if state is None:
+        # Start from the current time, so that a new database never goes back to the generation of a previous one
+        row, created = RatingGeneration.objects.get_or_create(
+            pk=GENERATION_PK, defaults={'generation': int(time.time() * 1000), 'modified': timezone.now()})
+        state = row.generation, row.modified
+
+    generation, modified = state
+    if timezone.is_naive(modified):
+        modified = timezone.make_aware(modified)
+    return generation, modified.astimezone(timezone.utc)
+
+
+def rating_generation():
+    """Counter changed each time ratings change"""
+    return rating_state()[0]
+
+
+def bump_rating_generation():
+    """Invalidate everything computed from the current ratings, when the current transaction is committed"""
+    changed = RatingGeneration.objects.filter(pk=GENERATION_PK).update(generation=F('generation') + 1,
+                                                                       modified=timezone.now())
+    if not changed:
+        rating_state()
+
+
+class RatingSnapshot:
+    """
+    Elo and number of games of all the persons, and the person of each identity, loaded with a single query.
+    Stored in arrays sorted by pk, searched by bisection, and never modified.
+    """
+    def __init__(self, generation, rows):
+        """'rows' are (person pk, elo, number of games, identity pk), sorted by person pk"""
+        self.generation = generation
+        self.person_ids = array('l')
+        self.elos = array('l')
+        self.ngames = array('l')
+        identities = []
+
+        for pk, elo, ngames, identity_id in rows:
+            if not self.person_ids or self.person_ids[-1] != pk:
+                self.person_ids.append(pk)
+                self.elos.append(elo or 0)
+                self.ngames.append(ngames or 0)
+            if identity_id is not None:
+                identities.append((identity_id, len(self.person_ids) - 1))
+
+        identities.sort()
+        self.identity_ids = array('l', [identity_id for identity_id, i in identities])
+        self.identity_persons = array('l', [i for identity_id, i in identities])
+
+    @classmethod
+    def from_database(cls, generation=None):
+        rows = Person.objects.order_by('pk').values_list('pk', 'elo', 'ngames', 'identity__pk')
+        return cls(generation, rows)
+
+    def __len__(self):
+        return len(self.person_ids)
+
+    @staticmethod
+    def _find(keys, key):
+        i = bisect.bisect_left(keys, key)
+        return i if key is not None and i < len(keys) and keys[i] == key else None
+
+    def rating(self, person_id):
+        """Elo and number of games of a person, or None if the person is unknown"""
+        i = self._find(self.person_ids, person_id)
+        return None if i is None else (self.elos[i], self.ngames[i])
+
+    def person_index(self, player):
+        """Index of the person of a Person or a Player, None if unknown"""
+        if isinstance(player, Person):
+            return self._find(self.person_ids, player.pk)
+
+        j = self._find(self.identity_ids, player.identity_id)
+        return None if j is None else self.identity_persons[j]
+
+    def elo(self, player):
+        """
+        Elo of a Person or a Player, without any query. Falls back on the instance for persons created
+        after the snapshot.
+        """
+        i = self.person_index(player)
+        if i is not None:
+            return self.elos[i]
+        elif isinstance(player, Person):
+            return player.elo
+        elif isinstance(player, Player) and player.identity_id is None:
+            return None
+        return player.get_elo()
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def rating_snapshot():
+    """
+    Ratings of the current process, loaded again when the rating generation changes, whichever process
+    changed them. Only the generation is read when the snapshot is up to date.
+    """
+    global _snapshot
+
+    generation = rating_generation()
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.generation != generation:
+            _snapshot = RatingSnapshot.from_database(generation)
+        return _snapshot
+
+
+class LRUCache:
+    """Dictionary of at most 'max_size' items, removing the least recently used ones"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class BalancingCache:
+    """
+    Results of team balancing, keyed by the persons of the roster, the options of the balancing and the rating
+    generation. Results are kept in the current process, then in the Django cache to share them with the other
+    processes. They are invalidated by any change of ratings.
+    """
+    def __init__(self, max_size=128, timeout=24 * 3600):
+        self.local = LRUCache(max_size)
+        self.timeout = timeout
+
+    @staticmethod
+    def key(person_ids, options):
+        roster = ",".join(str(pk) for pk in sorted(person_ids))
+        digest = hashlib.sha1("{}|{!r}".format(roster, sorted(options.items())).encode()).hexdigest()
+        return 'gametracker:balancing:{}:{}'.format(rating_generation(), digest)
+
+    def get_or_compute(self, person_ids, options, compute):
+        """Returns the cached result of the balancing, or calls compute() and caches its result"""
+        key = self.key(person_ids, options)
+
+        result = self.local.get(key)
+        if result is None:
+            result = cache.get(key)
+            if result is None:
+                result = compute()
+                cache.set(key, result, self.timeout)
+            self.local.put(key, result)
+
+        return result
+
+    def clear(self):
+        self.local.clear()
+
+
+_balancing_cache = None
+_balancing_cache_lock = threading.Lock()
+
+
+def balancing_cache():
+    """Balancing cache of the current process, configured by the GAMETRACKER_BALANCING_CACHE setting"""
+    global _balancing_cache
+
+    with _balancing_cache_lock:
+        if _balancing_cache is None:
+            config = getattr(settings, 'GAMETRACKER_BALANCING_CACHE', {})
+            _balancing_cache = BalancingCache(max_size=config.get('MAX_SIZE', 128),
+                                              timeout=config.get('TIMEOUT', 24 * 3600))
+    return _balancing_cache
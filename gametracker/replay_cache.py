@@ -0,0 +1,128 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+GAME_DATA_FILE = "game_data.json"
+MINIMAP_FILE = "minimap.png"
+CHRONOLOGY_FILE = "chronology.png"
+
+
+class ReplayCache:
+    """
+    Parser output and images of the replays, stored on disk under the SHA-256 of the replay file.
+    The least recently used entries are removed when the cache exceeds 'max_size' bytes.
+    """
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def get(self, sha256, minimap_file, chronology_file):
+        """Returns the game data and copy the images to the given files, or None if the replay is not cached"""
+        entry = self.path(sha256)
+
+        try:
+            with open(os.path.join(entry, GAME_DATA_FILE)) as f:
+                game_data = json.load(f)
+
+            for name, destination in ((MINIMAP_FILE, minimap_file), (CHRONOLOGY_FILE, chronology_file)):
+                if os.path.exists(os.path.join(entry, name)):
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    shutil.copyfile(os.path.join(entry, name), destination)
+
+            # The modification time of the entry is its last use
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+
+        return game_data
+
+    def put(self, sha256, game_data, minimap_file, chronology_file):
+        """Store the game data and the images generated by the parser"""
+        entry = self.path(sha256)
+        if os.path.exists(entry):
+            return
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # The entry is written in a temporary directory, then moved, so it is never seen incomplete
+        tmp = tempfile.mkdtemp(prefix='.', dir=os.path.dirname(entry))
+        try:
+            with open(os.path.join(tmp, GAME_DATA_FILE), 'w') as f:
+                json.dump(game_data, f)
+
+            for name, source in ((MINIMAP_FILE, minimap_file), (CHRONOLOGY_FILE, chronology_file)):
+                if os.path.exists(source):
+                    shutil.copyfile(source, os.path.join(tmp, name))
+
+            size = _entry_size(tmp)
+            os.rename(tmp, entry)
+        except OSError:
+            logger.exception("Can't add replay %s to the cache", sha256)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        with self.lock:
+            if self.size is not None:
+                self.size += size
+            if self.size is None or self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size"""
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_path = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+
+            for sha256 in os.listdir(prefix_path):
+                if sha256.startswith('.'):
+                    continue
+                entry = os.path.join(prefix_path, sha256)
+                try:
+                    entries.append((os.stat(entry).st_mtime, _entry_size(entry), entry))
+                except OSError:
+                    pass
+
+        self.size = sum(size for mtime, size, entry in entries)
+
+        for mtime, size, entry in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            self.size -= size
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def replay_cache():
+    """Cache of the current process, configured by the GAMETRACKER_REPLAY_CACHE setting. None if disabled"""
+    global _cache
+
+    config = getattr(settings, 'GAMETRACKER_REPLAY_CACHE', {})
+    if not config.get('DIRECTORY'):
+        return None
+
+    with _cache_lock:
+        if _cache is None or _cache.directory != config['DIRECTORY']:
+            _cache = ReplayCache(config['DIRECTORY'], config.get('MAX_SIZE', 512 * 1024 * 1024))
+    return _cache
@@ -0,0 +1,162 @@
+import operator
+
+from collections import namedtuple
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, When
+
+from gametracker.models import CivilizationMatchup, CivilizationStats, Game
+
+
+# Games and wins of a civilization (or of a map, or against an opponent), and percentage of wins
+Record = namedtuple('Record', ['name', 'games', 'wins', 'win_ratio'])
+
+
+def game_counts(game_map_id, winners, losers):
+    """
+    Games and wins added by a game to the statistics, from the civilizations of its winners and losers
+    (None when unknown). Returns {(civilization, map pk): [games, wins]} and
+    {(civilization, opponent civilization): [games, wins]}, each winner facing each loser.
+    """
+    winners = [civilization for civilization in winners if civilization]
+    losers = [civilization for civilization in losers if civilization]
+    stats, matchups = {}, {}
+
+    for civilization in winners:
+        _add_counts(stats, (civilization, game_map_id), 1, 1)
+    for civilization in losers:
+        _add_counts(stats, (civilization, game_map_id), 1, 0)
+
+    for winner in winners:
+        for loser in losers:
+            _add_counts(matchups, (winner, loser), 1, 1)
+            _add_counts(matchups, (loser, winner), 1, 0)
+
+    return stats, matchups
+
+
+def _add_counts(counts, key, games, wins):
+    total = counts.setdefault(key, [0, 0])
+    total[0] += games
+    total[1] += wins
+
+
+def team_civilizations(game):
+    """Civilizations of the winners and of the losers of a game"""
+    teams = {side: list(through.objects.filter(game_id=game.pk).values_list('player__civilization', flat=True))
+             for side, through in (("team1", Game.team1.through), ("team2", Game.team2.through))}
+
+    if game.winner == "team2":
+        return teams["team2"], teams["team1"]
+    return teams["team1"], teams["team2"]
+
+
+def add_game(game, winners=None, losers=None, sign=1):
+    """
+    Add a ranked game to the statistics, or remove it if sign is -1. The civilizations of the winners
+    and losers are loaded when they are not given. Only the rows of the game are updated, with the same
+    number of queries whatever the number of players and civilizations.
+    """
+    if not game.ranked:
+        return
+
+    if winners is None or losers is None:
+        winners, losers = team_civilizations(game)
+
+    stats, matchups = game_counts(game.game_map_id, winners, losers)
+
+    with transaction.atomic(savepoint=False):
+        _update(CivilizationStats, ('civilization', 'game_map_id'), stats, sign)
+        _update(CivilizationMatchup, ('civilization', 'opponent'), matchups, sign)
+
+
+def remove_game(game):
+    """Remove a ranked game from the statistics, before its teams are deleted"""
+    add_game(game, sign=-1)
+
+
+def _update(model, key_fields, counts, sign):
+    """
+    Add the games and wins of 'counts' ({key: [games, wins]}) to the rows of their keys, multiplied by 'sign'.
+    Missing rows are created empty (rows created at the same time by another worker are kept), then all the
+    rows are updated with a single query. Rows left without games are deleted.
+    """
+    if not counts:
+        return
+
+    changes = [(dict(zip(key_fields, key)), sign * games, sign * wins) for key, (games, wins) in counts.items()]
+    if sign > 0:
+        model.objects.bulk_create([model(**key) for key, games, wins in changes], ignore_conflicts=True)
+
+    rows = model.objects.filter(reduce(operator.or_, (Q(**key) for key, games, wins in changes)))
+    rows.update(games=Case(*[When(then=F('games') + games, **key) for key, games, wins in changes],
+                           default=F('games'), output_field=IntegerField()),
+                wins=Case(*[When(then=F('wins') + wins, **key) for key, games, wins in changes],
+                          default=F('wins'), output_field=IntegerField()))
+
+    if sign < 0:
+        rows.filter(games__lte=0).delete()
+
+
+def rebuild_stats():
+    """Calculate the statistics of all the ranked games in three queries, and replace the current ones"""
+    games = list(Game.objects.filter(ranked=True).values_list('pk', 'game_map_id', 'winner'))
+    teams = {pk: {"team1": [], "team2": []} for pk, game_map_id, winner in games}
+
+    for side, through in (("team1", Game.team1.through), ("team2", Game.team2.through)):
+        rows = through.objects.filter(game__ranked=True).values_list('game_id', 'player__civilization')
+        for game_id, civilization in rows:
+            teams[game_id][side].append(civilization)
+
+    stats, matchups = {}, {}
+    for pk, game_map_id, winner in games:
+        winners, losers = ("team2", "team1") if winner == "team2" else ("team1", "team2")
+        game_stats, game_matchups = game_counts(game_map_id, teams[pk][winners], teams[pk][losers])
+
+        for totals, counts in ((stats, game_stats), (matchups, game_matchups)):
+            for key, (n_games, wins) in counts.items():
+                _add_counts(totals, key, n_games, wins)
+
+    with transaction.atomic():
+        CivilizationStats.objects.all().delete()
+        CivilizationMatchup.objects.all().delete()
+        CivilizationStats.objects.bulk_create(
+            CivilizationStats(civilization=civilization, game_map_id=game_map_id, games=n_games, wins=wins)
+            for (civilization, game_map_id), (n_games, wins) in stats.items())
+        CivilizationMatchup.objects.bulk_create(
+            CivilizationMatchup(civilization=civilization, opponent=opponent, games=n_games, wins=wins)
+            for (civilization, opponent), (n_games, wins) in matchups.items())
+
+
+def _records(rows):
+    """
+    Records of (name, games, wins) rows, summed by name, most wins in proportion first. The name of games
+    without map is None.
+    """
+    counts = {}
+    for name, games, wins in rows:
+        _add_counts(counts, name, games, wins)
+
+    records = [Record(name, games, wins, wins * 100.0 / games) for name, (games, wins) in counts.items() if games]
+    return sorted(records, key=lambda record: (-record.win_ratio, -record.games, record.name or ""))
+
+
+def civilization_stats(game_map=None):
+    """Record of each civilization, on a map or on all the maps"""
+    rows = CivilizationStats.objects.all()
+    if game_map is not None:
+        rows = rows.filter(game_map=game_map)
+    return _records(rows.values_list('civilization', 'games', 'wins'))
+
+
+def map_stats(civilization):
+    """Record of a civilization on each map"""
+    rows = CivilizationStats.objects.filter(civilization=civilization)
+    return _records(rows.values_list('game_map__name', 'games', 'wins'))
+
+
+def matchup_stats(civilization):
+    """Record of a civilization against each other civilization"""
+    rows = CivilizationMatchup.objects.filter(civilization=civilization)
+    return _records(rows.values_list('opponent', 'games', 'wins'))
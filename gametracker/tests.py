@@ -1,12 +1,42 @@
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import os
+import time
+import itertools
+import shutil
+import tempfile
+
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from random import Random
+from unittest import mock, skipIf
+
+from django import forms
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
 
-from gametracker.utils import TeamBalancer, calc_team_elo, prob_winning, calculate_new_elo
-from gametracker import factories
-from gametracker.signals import update_elo
+from gametracker.utils import (TeamBalancer, MultiTeamBalancer, calc_team_elo, prob_winning, calculate_new_elo,
+                               team_elo_formula)
+from gametracker import factories, utils
+from gametracker.elo import EloEngine
+from gametracker.forms import GameForm
+from gametracker.history import filter_games, history_page
+from gametracker.leaderboard import leaderboard_at, rank_movements
+from gametracker.ingestion import claim_jobs, process_jobs, import_replay_files, parse_replay_file, save_game
+from gametracker.models import (CivilizationMatchup, CivilizationStats, EloCheckpoint, EloLog, Game, GamePlayer,
+                                GameReplay, Person, Player, ReplayJob)
+from gametracker.ratings import (LRUCache, RatingSnapshot, balancing_cache, bump_rating_generation,
+                                 rating_snapshot)
+from gametracker.replay_cache import ReplayCache
+from gametracker.parsers import ReplayParser, ParserService, ReplayParserError, ReplayParserTimeout
+from gametracker.signals import update_elo, deferred_elo_update
+from gametracker.stats import add_game, civilization_stats, matchup_stats, rebuild_stats
 
 
 
@@ -131,6 +161,169 @@ class UtilsTest(TestCase):
         self.assertEqual(calculate_new_elo(2000, -100, False), round(2000 + 20 * (0 - prob_winning(-100))))
 
 
+class RatingSnapshotTest(TestCase):
+    def setUp(self):
+        elos = [2000, 1800, 2100]
+        self.persons = [factories.PersonFactory(init_elo=elo) for elo in elos]
+        self.players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=p)) for p in self.persons]
+
+    def test_snapshot(self):
+        """All the ratings are loaded with one query, then read without any query"""
+        with self.assertNumQueries(1):
+            snapshot = RatingSnapshot.from_database()
+
+        players = Player.objects.filter(pk__in=[p.pk for p in self.players])
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(snapshot.elo(player) for player in players), [1800, 2000, 2100])
+        self.assertEqual(snapshot.rating(self.persons[0].pk), (2000, 0))
+        self.assertIsNone(snapshot.rating(-1))
+
+        # Persons created after the snapshot still have their elo
+        person = factories.PersonFactory(init_elo=1500)
+        self.assertEqual(snapshot.elo(person), 1500)
+
+    def test_reload(self):
+        """The snapshot is loaded again when ratings change"""
+        snapshot = rating_snapshot()
+        self.assertIs(rating_snapshot(), snapshot)
+
+        Person.objects.filter(pk=self.persons[0].pk).update(elo=2200)
+        bump_rating_generation()
+        self.assertEqual(rating_snapshot().elo(self.persons[0]), 2200)
+
+        # Only the rating generation is read
+        players = list(Player.objects.filter(pk__in=[p.pk for p in self.players[1:]]))
+        with self.assertNumQueries(1):
+            self.assertEqual(calc_team_elo(players), team_elo_formula([1800, 2100]))
+
+        # Ratings recomputed by a replay worker, which does not share the cache of this process
+        factories.GameFactory.create(team1=[self.players[1]], team2=[self.players[2]])
+        with mock.patch('gametracker.ratings.cache', LocMemCache('worker', {})):
+            update_elo()
+        self.assertEqual(rating_snapshot().elo(self.persons[1]), Person.objects.get(pk=self.persons[1].pk).elo)
+        self.assertNotEqual(rating_snapshot().elo(self.persons[1]), 1800)
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        self.players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=factories.PersonFactory()))
+                        for i in range(4)]
+        now = timezone.now()
+        self.games = []
+        for i in range(7):
+            # Two games at the same date, to check the order on pks
+            self.games.append(factories.GameFactory(team1=self.players[:2], team2=self.players[2:], winner="team2",
+                                                    date=now + timedelta(minutes=i // 2),
+                                                    game_map=factories.GameMapFactory()))
+
+    def test_pages(self):
+        """All the games in order, most recent first, with a fixed number of queries per page"""
+        expected = sorted(self.games, key=lambda game: (game.date, game.pk), reverse=True)
+        games, cursor = [], None
+        while True:
+            # Games are counted with the first page, by the same query if the database has window functions
+            with self.assertNumQueries(2 if cursor or connection.features.supports_over_clause else 3):
+                page, cursor, count = history_page(cursor=cursor, page_size=3)
+            games.extend(page)
+            if cursor is None:
+                break
+
+        self.assertEqual(games, expected)
+        self.assertEqual(games[0].winner_pseudos, [player.identity.pseudo for player in self.players[2:]])
+        self.assertEqual(games[0].loser_pseudos, [player.identity.pseudo for player in self.players[:2]])
+
+    def test_json(self):
+        response = self.client.get(reverse('gametracker:history_json'))
+        page = response.json()
+        self.assertEqual(len(page['games']), 7)
+        self.assertIsNone(page['next'])
+        self.assertIn(page['games'][0]['winners'][0], page['html'])
+
+        response = self.client.get(reverse('gametracker:history'))
+        self.assertContains(response, page['games'][0]['winners'][0])
+        self.assertIsNone(response.context['next_cursor'])
+
+        response = self.client.get(reverse('gametracker:history'), {'before': "invalid"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_filters(self):
+        """Games are filtered by player, map, civilization, ranking and date, and counted"""
+        other = factories.PlayerFactory(identity=factories.IdentityFactory(person=factories.PersonFactory()),
+                                        civilization="Mayans")
+        game = factories.GameFactory(team1=[self.players[0]], team2=[other], ranked=False,
+                                     date=timezone.now() - timedelta(days=3), game_map=self.games[0].game_map)
+
+        def filtered(**filters):
+            page = history_page(filter_games(Game.objects.all(), **filters))
+            self.assertEqual(page.count, len(page.games))
+            return page.games
+
+        self.assertEqual(filtered(player=other.identity.person), [game])
+        self.assertEqual(len(filtered(player=self.players[0].identity.person)), 8)
+        self.assertEqual(filtered(civilization="Mayans"), [game])
+        self.assertEqual(filtered(ranked=False), [game])
+        self.assertEqual(filtered(game_map=game.game_map), [self.games[0], game])
+        self.assertEqual(filtered(end=(timezone.now() - timedelta(days=1)).date()), [game])
+        self.assertEqual(len(filtered(start=timezone.now().date())), 7)
+
+        response = self.client.get(reverse('gametracker:history'), {'player': other.identity.person.name})
+        self.assertEqual((response.context['n_games'], list(response.context['game_list'])), (1, [game]))
+        self.assertEqual(response.context['filter_query'], "player=" + other.identity.person.name)
+
+        # Invalid filters are ignored
+        response = self.client.get(reverse('gametracker:history_json'), {'ranked': "0", 'game_map': "-1"})
+        self.assertEqual([g['pk'] for g in response.json()['games']], [game.pk])
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.persons = [factories.PersonFactory(init_elo=elo) for elo in (2000, 1800)]
+
+    def test_cached_fragments(self):
+        """The leaderboard is only queried once per rating generation and language"""
+        response = self.client.get(reverse('gametracker:players'))
+        self.assertContains(response, self.persons[0].name)
+
+        # Only the rating generation is read
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('gametracker:players'))
+        self.assertContains(response, self.persons[0].name)
+
+        bump_rating_generation()
+        with self.assertNumQueries(3):
+            self.client.get(reverse('gametracker:players'))
+
+    def test_conditional_requests(self):
+        """Browsers revalidate the leaderboard with its ETag or Last-Modified date"""
+        response = self.client.get(reverse('gametracker:index'))
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(reverse('gametracker:index'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        etag = response['ETag']
+        bump_rating_generation()
+        response = self.client.get(reverse('gametracker:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_worker_update(self):
+        """Ratings recomputed by a replay worker, which does not share the cache of this process, change the ETag"""
+        players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=p)) for p in self.persons]
+        factories.GameFactory.create(team1=[players[1]], team2=[players[0]])
+        etag = self.client.get(reverse('gametracker:index'))['ETag']
+
+        with mock.patch('gametracker.ratings.cache', LocMemCache('worker', {})):
+            update_elo()
+
+        response = self.client.get(reverse('gametracker:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, Person.objects.get(pk=self.persons[1].pk).elo)
+
+
 class IntegrationTests(TestCase):
     def setUp(self):
         elos = [2000, 1800, 2100]
@@ -243,7 +436,666 @@ class IntegrationTests(TestCase):
         self.assertEqual(self.players[1].get_elo(), player2_copy.get_elo(), 0)
 
 
+class EloCheckpointTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch('gametracker.signals.CHECKPOINT_INTERVAL', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        elos = [2000, 1800, 2100, 1600]
+        self.persons = [factories.PersonFactory(init_elo=elo) for elo in elos]
+        self.identities = [factories.IdentityFactory(person=p) for p in self.persons]
+        self.players = [factories.PlayerFactory(identity=identity) for identity in self.identities]
+        self.start = timezone.now() - timedelta(days=1)
+
+        for i in range(8):
+            factories.GameFactory.create(date=self.start + timedelta(hours=i),
+                                         team1=[self.players[i % 4]], team2=[self.players[(i + 1) % 4]],
+                                         winner="team1" if i % 3 else "team2")
+        update_elo()
+
+    def get_elos(self):
+        for person in self.persons:
+            person.refresh_from_db()
+        return [(person.elo, person.ngames) for person in self.persons]
+
+    def test_checkpoints_created(self):
+        """Checkpoints are taken every CHECKPOINT_INTERVAL games"""
+        self.assertEqual(EloCheckpoint.objects.count(), 3)
+
+    def test_late_game(self):
+        """Adding a game in the past gives the same result as a full recalculation"""
+        first_log = EloLog.objects.filter(date=self.start).first()
+        date = self.start + timedelta(hours=4, minutes=30)
+        factories.GameFactory.create(date=date, team1=[self.players[0], self.players[3]],
+                                     team2=[self.players[1], self.players[2]])
+
+        update_elo(date)
+        incremental = self.get_elos()
+
+        # Logs older than the restart checkpoint are kept
+        self.assertTrue(EloLog.objects.filter(pk=first_log.pk).exists())
+
+        update_elo()
+        self.assertEqual(incremental, self.get_elos())
+
+
+class EloEngineTest(TestCase):
+    def setUp(self):
+        elos = [2000, 1800, 2100]
+        self.persons = [factories.PersonFactory(init_elo=elo) for elo in elos]
+        self.identities = [factories.IdentityFactory(person=p) for p in self.persons]
+        self.players = [factories.PlayerFactory(identity=identity) for identity in self.identities]
+
+    def test_run(self):
+        """The engine gives the same elo as the formulas applied on model instances"""
+        factories.GameFactory.create(team1=self.players[:2], team2=[self.players[2]], winner="team2")
+        factories.GameFactory.create(team1=[self.players[0]], team2=[self.players[2]], ranked=False)
+
+        engine = EloEngine.from_database()
+        result = engine.run([p.elo for p in self.persons], [0, 0, 0])
+
+        delta_elo = calc_team_elo(self.persons[:2]) - calc_team_elo([self.persons[2]])
+        expected = [calculate_new_elo(2000, delta_elo, False), calculate_new_elo(1800, delta_elo, False),
+                    calculate_new_elo(2100, -delta_elo, True)]
+
+        self.assertEqual(len(engine), 2)
+        self.assertEqual([result.elos[engine.index[p.pk]] for p in self.persons], expected)
+        self.assertEqual([result.ngames[engine.index[p.pk]] for p in self.persons], [1, 1, 1])
+        self.assertEqual(len(result.logs), 3)
+
+
+class GamePlayerTest(TestCase):
+    def setUp(self):
+        self.persons = [factories.PersonFactory(name=name, init_elo=elo)
+                        for name, elo in (("Foo", 2000), ("Bar", 1800), ("Baz", 2100))]
+        self.players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=p), civilization="Celts")
+                        for p in self.persons]
+
+    def test_results(self):
+        """Elo update stores the result of each person in each game"""
+        game = factories.GameFactory.create(team1=self.players[:2], team2=[self.players[2]], winner="team2",
+                                            game_map=factories.GameMapFactory())
+        update_elo()
+
+        results = {r.person_id: r for r in GamePlayer.objects.filter(game=game)}
+        self.assertEqual([results[p.pk].side for p in self.persons], [1, 1, 2])
+        self.assertEqual([results[p.pk].won for p in self.persons], [False, False, True])
+        self.assertEqual(results[self.persons[0].pk].civilization, "Celts")
+        self.assertEqual(results[self.persons[0].pk].game_map_id, game.game_map_id)
+
+        for person in self.persons:
+            person.refresh_from_db()
+            self.assertEqual(results[person.pk].elo_before, person.init_elo)
+            self.assertEqual(results[person.pk].elo_after, person.elo)
+
+        # Probability of winning before the game, the same one as the team balancing page
+        p1 = prob_winning(team_elo_formula([2000, 1800]) - team_elo_formula([2100]))
+        self.assertAlmostEqual(results[self.persons[0].pk].win_probability, p1)
+        self.assertAlmostEqual(results[self.persons[2].pk].win_probability, 1 - p1)
+
+        # Results are rebuilt after a deletion
+        game.delete()
+        self.assertFalse(GamePlayer.objects.exists())
+
+    def test_person_detail(self):
+        """The profile page does not depend on the number of games"""
+        factories.GameFactory.create(team1=[self.players[0]], team2=[self.players[1]])
+        update_elo()
+        url = reverse('gametracker:player', kwargs={'person_name': "Foo"})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual((response.context['victories'], response.context['defeats']), (1, 0))
+
+        for i in range(5):
+            factories.GameFactory.create(team1=[self.players[1]], team2=[self.players[0]], winner="team1")
+        update_elo()
+
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertEqual((response.context['victories'], response.context['defeats']), (1, 5))
+
+
+    def test_game_detail(self):
+        """Elo variation of each player, with a fixed number of queries"""
+        game = factories.GameFactory.create(team1=self.players[:2], team2=[self.players[2]], winner="team2",
+                                            game_map=factories.GameMapFactory())
+        update_elo()
+
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('gametracker:game', kwargs={'pk': game.pk}))
+
+        for player in response.context['winners'] + response.context['losers']:
+            person = player.identity.person
+            person.refresh_from_db()
+            self.assertEqual(player.result.elo_delta, person.elo - person.init_elo)
+        self.assertGreater(response.context['winners'][0].result.elo_delta, 0)
+        self.assertAlmostEqual(response.context['pw_winners'] + response.context['pw_losers'], 100)
+
+
+    def test_elo_series(self):
+        """The elo history is downsampled, keeping the first and last games"""
+        now = timezone.now()
+        for i in range(30):
+            factories.GameFactory.create(team1=[self.players[i % 2]], team2=[self.players[1 - i % 2]],
+                                         date=now - timedelta(days=30 - i))
+        update_elo()
+        url = reverse('gametracker:player_elo', kwargs={'person_name': "Foo"})
+
+        series = self.client.get(url, {'points': 10}).json()
+        self.assertEqual((series['count'], len(series['points'])), (31, 10))
+        self.assertEqual([series['points'][0]['game'], series['points'][-1]['game']], [0, 30])
+        self.assertIsNone(series['points'][0]['date'])
+        self.assertEqual(series['points'][-1]['elo'], Person.objects.get(name="Foo").elo)
+
+        # Games are still numbered from the first one
+        start = (now - timedelta(days=5)).date()
+        series = self.client.get(url, {'start': start.isoformat()}).json()
+        self.assertEqual([point['game'] for point in series['points']], list(range(26, 31)))
+
+        self.assertEqual(self.client.get(url, {'end': "yesterday"}).status_code, 400)
+
+    def test_downsample(self):
+        ys = [0, 1, 0, 5, 0, 1, 0, 1, 0, 1]
+        indexes = utils.downsample(list(range(10)), ys, 4)
+        self.assertEqual((len(indexes), indexes[0], indexes[-1]), (4, 0, 9))
+        self.assertIn(3, indexes)
+        self.assertEqual(utils.downsample([0, 1], [0, 1], 5), [0, 1])
+
+
+class PastLeaderboardTest(TestCase):
+    def setUp(self):
+        self.persons = [factories.PersonFactory(name=name, init_elo=elo)
+                        for name, elo in (("Foo", 2000), ("Bar", 1990), ("Baz", 1700))]
+        self.players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=p)) for p in self.persons]
+        self.now = timezone.now()
+
+        # Foo beats Bar, Bar beats Foo twice, then Baz plays later
+        for i, winner in enumerate((0, 1, 1)):
+            factories.GameFactory.create(team1=[self.players[winner]], team2=[self.players[1 - winner]],
+                                         date=self.now - timedelta(days=10 - i))
+        factories.GameFactory.create(team1=[self.players[2]], team2=[self.players[0]],
+                                     date=self.now - timedelta(days=2))
+        update_elo()
+
+    def test_leaderboard_at(self):
+        """Latest elo of each person at the date, with a single query"""
+        with self.assertNumQueries(1):
+            standings = leaderboard_at(self.now)
+        for person in self.persons:
+            person.refresh_from_db()
+        self.assertEqual([(s.person, s.elo) for s in standings],
+                         sorted([(p, p.elo) for p in self.persons], key=lambda standing: -standing[1]))
+
+        # Baz had not played yet
+        standings = leaderboard_at(self.now - timedelta(days=5))
+        self.assertEqual([(s.rank, s.person.name) for s in standings], [(1, "Bar"), (2, "Foo")])
+        self.assertEqual(standings[0].elo, EloLog.objects.filter(person=self.persons[1]).latest('date').elo)
+
+        self.assertEqual(leaderboard_at(self.now - timedelta(days=30)), [])
+
+    def test_rank_movements(self):
+        movements = rank_movements(self.now - timedelta(days=9, hours=12), self.now)
+        movements = {movement.person.name: movement for movement in movements}
+        self.assertEqual((movements["Bar"].previous_rank, movements["Bar"].movement), (2, 1))
+        self.assertIsNone(movements["Baz"].movement)
+
+        response = self.client.get(reverse('gametracker:past_leaderboard'),
+                                   {'date': self.now.strftime("%Y-%m-%dT%H:%M"), 'since': "2000-01-01"})
+        self.assertContains(response, "Nouveau", count=3)
+
+        response = self.client.get(reverse('gametracker:past_leaderboard_json'), {'date': "invalid"})
+        self.assertIn('date', response.json()['errors'])
+
+
+class CivilizationStatsTest(TestCase):
+    def setUp(self):
+        self.maps = [factories.GameMapFactory(name=name) for name in ("Arabia", "Islands")]
+        self.players = [factories.PlayerFactory(civilization=civilization)
+                        for civilization in ("Franks", "Celts", "Mongols", "Franks", None)]
+
+        franks, celts, mongols, franks2, unknown = self.players
+        self.games = [factories.GameFactory.create(team1=[franks, celts], team2=[mongols, unknown],
+                                                   game_map=self.maps[0]),
+                      factories.GameFactory.create(team1=[mongols], team2=[franks2], game_map=self.maps[0],
+                                                   winner="team2"),
+                      factories.GameFactory.create(team1=[celts], team2=[franks], game_map=self.maps[1]),
+                      factories.GameFactory.create(team1=[celts], team2=[mongols], game_map=self.maps[1],
+                                                   ranked=False)]
+        for game in self.games:
+            add_game(game)
+
+    def rows(self):
+        return (sorted(CivilizationStats.objects.values_list('civilization', 'game_map', 'games', 'wins')),
+                sorted(CivilizationMatchup.objects.values_list('civilization', 'opponent', 'games', 'wins')))
+
+    def test_incremental_update(self):
+        """Statistics updated game by game are the same as statistics rebuilt from all the games"""
+        self.assertIn(("Franks", self.maps[0].pk, 2, 2), self.rows()[0])
+        self.assertIn(("Mongols", "Franks", 2, 0), self.rows()[1])
+
+        rows = self.rows()
+        rebuild_stats()
+        self.assertEqual(self.rows(), rows)
+
+        # Deleted games are removed, and rows without games are deleted
+        self.games[2].delete()
+        rows = self.rows()
+        self.assertFalse(CivilizationStats.objects.filter(game_map=self.maps[1]).exists())
+        rebuild_stats()
+        self.assertEqual(self.rows(), rows)
+
+    def test_manually_added_game(self):
+        """Games created from the form are added to the statistics"""
+        franks, celts = self.players[0], self.players[1]
+
+        # The choices of the form are built when it is imported
+        teams = {team: forms.ModelMultipleChoiceField(queryset=Player.objects.all()) for team in ('team1', 'team2')}
+        with mock.patch.dict(GameForm.base_fields, teams):
+            response = self.client.post(reverse('gametracker:manually_add_game'),
+                                        {'game_map': self.maps[1].pk, 'team1': [celts.pk], 'team2': [franks.pk]})
+        self.assertRedirects(response, reverse('gametracker:history'), fetch_redirect_response=False)
+
+        self.assertEqual(CivilizationStats.objects.get(civilization="Celts", game_map=self.maps[1]).wins, 2)
+        self.assertEqual(CivilizationMatchup.objects.get(civilization="Franks", opponent="Celts").games, 2)
+
+    def test_games_without_map(self):
+        """Games without map share a single row per civilization"""
+        games = [factories.GameFactory.create(team1=[self.players[2]], team2=[self.players[1]]) for i in range(2)]
+        for game in games:
+            add_game(game)
+
+        self.assertEqual(list(CivilizationStats.objects.filter(game_map=None).values_list('civilization', 'games')
+                                                       .order_by('civilization')),
+                         [("Celts", 2), ("Mongols", 2)])
+
+        games[0].delete()
+        games[1].delete()
+        self.assertFalse(CivilizationStats.objects.filter(game_map=None).exists())
+
+    def test_map_without_name(self):
+        """Games without map are listed with the other maps of a civilization"""
+        add_game(factories.GameFactory.create(team1=[self.players[1]], team2=[self.players[2]]))
+
+        response = self.client.get(reverse('gametracker:stats_json'), {'civilization': "Celts"})
+        self.assertEqual([(record['name'], record['games']) for record in response.json()['maps']],
+                         [(None, 1), ("Arabia", 1), ("Islands", 1)])
+
+        response = self.client.get(reverse('gametracker:stats'), {'civilization': "Celts"})
+        self.assertContains(response, "Inconnue")
+
+    def test_records(self):
+        self.assertEqual([tuple(record) for record in civilization_stats()],
+                         [("Celts", 2, 2, 100.0), ("Franks", 3, 2, 100.0 * 2 / 3), ("Mongols", 2, 0, 0.0)])
+        self.assertEqual([(record.name, record.games, record.wins) for record in matchup_stats("Franks")],
+                         [("Mongols", 2, 2), ("Celts", 1, 0)])
+
+    def test_stats_page(self):
+        # The map and the civilizations of the form, then the three statistics
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('gametracker:stats_json'),
+                                       {'game_map': self.maps[0].pk, 'civilization': "Franks"})
+        data = response.json()
+        self.assertEqual(data['map'], "Arabia")
+        self.assertEqual([record['name'] for record in data['civilizations']], ["Franks", "Celts", "Mongols"])
+        self.assertEqual(data['maps'], [{'name': "Arabia", 'games': 2, 'wins': 2, 'win_ratio': 100.0},
+                                        {'name': "Islands", 'games': 1, 'wins': 0, 'win_ratio': 0.0}])
+
+        response = self.client.get(reverse('gametracker:stats'), {'civilization': "Celts"})
+        self.assertContains(response, "Celts contre les autres civilisations")
+
+
+class SaveRatingsTest(TestCase):
+    def count_update_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            update_elo()
+        return len(context.captured_queries)
+
+    def test_constant_queries(self):
+        """Saving ratings does not depend on the number of persons"""
+        persons = [factories.PersonFactory(init_elo=elo) for elo in (2000, 1800)]
+        players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=p)) for p in persons]
+        factories.GameFactory.create(team1=[players[0]], team2=[players[1]])
+        n_queries = self.count_update_queries()
+
+        more_persons = [factories.PersonFactory(init_elo=1500 + i) for i in range(10)]
+        more_players = [factories.PlayerFactory(identity=factories.IdentityFactory(person=p)) for p in more_persons]
+        factories.GameFactory.create(team1=more_players[:5], team2=more_players[5:])
+
+        self.assertEqual(self.count_update_queries(), n_queries)
+
+        persons[0].refresh_from_db()
+        self.assertEqual(persons[0].ngames, 1)
+        self.assertEqual(persons[0].elo, calculate_new_elo(2000, 200, True))
+
+
+class DeferredEloUpdateTest(TransactionTestCase):
+    def test_delete_games(self):
+        """Deleting several games updates elo only once, from the earliest date"""
+        start = timezone.now() - timedelta(days=1)
+        games = [factories.GameFactory.create(date=start + timedelta(hours=i)) for i in (3, 1, 2)]
+
+        with mock.patch('gametracker.signals.update_elo') as update:
+            with deferred_elo_update():
+                with deferred_elo_update():
+                    games[0].delete()
+                games[1].delete()
+                games[2].delete()
+                self.assertFalse(update.called)
+
+        update.assert_called_once_with(games[1].date)
+
+
+GAME_DATA = {"version": "AOC 1.0c", "type": "Random Map", "speed": "normal", "difficulty": "hard",
+             "population_limit": 200, "map": "Arabia",
+             "players": {"Foo": {"civilization": "Franks", "resign_time": 0, "team": 1},
+                         "Bar": {"civilization": "Celts", "resign_time": 1200, "team": 2}}}
+
+
+class ReplayJobTest(TestCase):
+    def setUp(self):
+        self.persons = [factories.PersonFactory(name=name, init_elo=elo) for name, elo in (("Foo", 2000), ("Bar", 1800))]
+
+    def upload(self, name="rec.20181015-203040.mgz", data=b"replay data"):
+        replay = SimpleUploadedFile(name, data)
+        return self.client.post(reverse('gametracker:add_game'), {'replay': replay})
+
+    @mock.patch('gametracker.ingestion.parse_replay', return_value=(GAME_DATA, '', ''))
+    def test_add_game(self, parse_replay):
+        """Replays are analyzed by the workers, then the job redirects to the game"""
+        response = self.upload()
+        job = ReplayJob.objects.get()
+        self.assertRedirects(response, reverse('gametracker:replay_job', kwargs={'pk': job.pk}),
+                             fetch_redirect_response=False)
+        self.assertFalse(parse_replay.called)
+
+        response = self.client.get(reverse('gametracker:replay_job', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(process_jobs(10), 1)
+        game = Game.objects.get()
+        self.assertEqual(game.winner, "team1")
+
+        response = self.client.get(reverse('gametracker:replay_job', kwargs={'pk': job.pk}))
+        self.assertRedirects(response, reverse('gametracker:game', kwargs={'pk': game.pk}),
+                             fetch_redirect_response=False)
+
+        self.persons[0].refresh_from_db()
+        self.assertEqual(self.persons[0].elo, calculate_new_elo(2000, 200, True))
+
+        # The job of a deleted game
+        game.delete()
+        response = self.client.get(reverse('gametracker:replay_job', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 404)
+
+    @mock.patch('gametracker.ingestion.parse_replay', return_value=(GAME_DATA, '', ''))
+    @mock.patch('gametracker.ingestion.update_elo')
+    def test_coalesced_elo_update(self, update, parse_replay):
+        """Elo is updated once for all the jobs processed together"""
+        self.upload("rec.20181015-203040.mgz")
+        self.upload("rec.20181014-203040.mgz", b"other data")
+        self.assertEqual(process_jobs(10), 2)
+
+        update.assert_called_once_with(Game.objects.order_by('date').first().date)
+
+    @mock.patch('gametracker.ingestion.parse_replay', return_value=(GAME_DATA, '', ''))
+    def test_known_replay(self, parse_replay):
+        """A replay uploaded twice is not analyzed again"""
+        self.upload()
+        process_jobs(10)
+        game = Game.objects.get()
+        self.assertEqual(GameReplay.objects.get().sha256,
+                         "0a5c65544bf6ba5355a50e63f93505237e7c6a56c3460d042098d0e7498a0f06")
+
+        response = self.upload("other-name.mgz")
+        self.assertRedirects(response, reverse('gametracker:game', kwargs={'pk': game.pk}),
+                             fetch_redirect_response=False)
+        self.assertEqual(GameReplay.objects.count(), 1)
+        self.assertEqual(ReplayJob.objects.count(), 1)
+
+    @mock.patch('gametracker.ingestion.parse_replay', return_value=(GAME_DATA, '', ''))
+    def test_duplicated_game(self, parse_replay):
+        """A different replay of a known game is deleted after the analysis"""
+        self.upload()
+        self.upload(data=b"other data")
+        process_jobs(10)
+
+        self.assertEqual(Game.objects.count(), 1)
+        self.assertEqual(GameReplay.objects.count(), 1)
+        self.assertEqual(ReplayJob.objects.filter(status=ReplayJob.DUPLICATE).count(), 1)
+
+    def test_stale_jobs(self):
+        """Jobs left running by a dead worker are claimed again"""
+        self.upload()
+        self.upload(data=b"other data")
+        stale, running = ReplayJob.objects.order_by('pk')
+        ReplayJob.objects.filter(pk=stale.pk).update(status=ReplayJob.RUNNING,
+                                                     started=timezone.now() - timedelta(hours=1))
+        ReplayJob.objects.filter(pk=running.pk).update(status=ReplayJob.RUNNING, started=timezone.now())
+
+        self.assertEqual(claim_jobs(10), [stale.pk])
+        self.assertEqual(claim_jobs(10), [])
+
+    @mock.patch('gametracker.ingestion.parse_replay', side_effect=ValueError)
+    def test_failed_job(self, parse_replay):
+        self.upload()
+        process_jobs(10)
+        self.assertEqual(ReplayJob.objects.get().status, ReplayJob.FAILED)
+        self.assertFalse(Game.objects.exists())
+
+
+class SaveGameTest(TestCase):
+    def game_data(self, n_players, known=()):
+        players = {"Player{}".format(i): {"civilization": "Civilization{}".format(i),
+                                          "resign_time": 0 if i % 2 else 1200, "team": 1 + i % 2}
+                   for i in range(n_players)}
+        players.update({name: {"civilization": "Celts", "resign_time": 0, "team": 1} for name in known})
+        return dict(GAME_DATA, players=players)
+
+    def save(self, game_data, date):
+        replay = GameReplay.objects.create(replay="games/rec.mgz")
+        with CaptureQueriesContext(connection) as queries:
+            game, created = save_game(replay, game_data, date, "/minimaps/rec.png", "/researches/rec.png")
+        self.assertTrue(created)
+        return game, len(queries)
+
+    def test_save_game(self):
+        """Players, identities and teams are created"""
+        person = factories.PersonFactory(name="Foo")
+        game, n_queries = self.save(self.game_data(3, known=["Foo"]), timezone.now())
+
+        self.assertTrue(game.ranked)
+        self.assertEqual(game.winner, "team2")
+        self.assertEqual(sorted(CivilizationStats.objects.values_list('civilization', 'games', 'wins')),
+                         [("Celts", 1, 0), ("Civilization0", 1, 0), ("Civilization1", 1, 1), ("Civilization2", 1, 0)])
+        self.assertEqual(sorted(str(p) for p in game.team1.all()), ["Foo", "Player0", "Player2"])
+        self.assertEqual(sorted(str(p) for p in game.team2.all()), ["Player1"])
+        self.assertEqual(game.team1.get(identity__pseudo="Foo").identity.person, person)
+        self.assertEqual(GameReplay.objects.get(pk=game.replay_id).minimap.name, "/minimaps/rec.png")
+
+    def test_query_budget(self):
+        """The number of queries does not depend on the number of players"""
+        self.save(self.game_data(2), timezone.now())
+
+        budgets = set()
+        for i, n_players in enumerate((2, 8, 16)):
+            game, n_queries = self.save(self.game_data(n_players, known=["Known{}".format(i)]),
+                                        timezone.now() + timedelta(days=i + 1))
+            self.assertEqual(game.team1.count() + game.team2.count(), n_players + 1)
+            budgets.add(n_queries)
+
+        self.assertEqual(len(budgets), 1)
+        # Two more queries than PostgreSQL on SQLite, to get the keys of the inserted rows, and two queries
+        # per statistics table
+        self.assertLessEqual(budgets.pop(), 17)
+
+
+class ImportReplaysTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.storage = GameReplay._meta.get_field('replay').storage
+
+    def replay_files(self, *names):
+        paths = []
+        for name in names:
+            paths.append(os.path.join(self.directory, name))
+            with open(paths[-1], 'wb') as replay_file:
+                replay_file.write(b"replay data")
+        return paths
+
+    def stored_replays(self):
+        return set(self.storage.listdir('games')[1]) if self.storage.exists('games') else set()
+
+    def test_import(self):
+        """Replays are added in a batch, without analysis jobs, and duplicates are skipped"""
+        paths = self.replay_files("rec.20181015-203040.mgz", "rec.20181016-203040.mgz", "copy-rec.20181016-203040.mgz")
+
+        games, n_duplicates = import_replay_files([(path, str(i), GAME_DATA, '', '') for i, path in enumerate(paths)])
+
+        self.assertEqual(len(games), 2)
+        self.assertEqual(n_duplicates, 1)
+        self.assertEqual(GameReplay.objects.count(), 2)
+        self.assertFalse(ReplayJob.objects.exists())
+        self.assertEqual(set(game.replay.game_version for game in Game.objects.all()), {"AOC 1.0c"})
+
+        games, n_duplicates = import_replay_files([(paths[0], '3', GAME_DATA, '', '')])
+        self.assertEqual((len(games), n_duplicates), (0, 1))
+
+    def test_concurrent_game(self):
+        """A game added after the games were filtered is a duplicate, its replay is deleted"""
+        game = factories.GameFactory.create()
+        stored = self.stored_replays()
+        paths = self.replay_files("rec.20181017-203040.mgz")
+
+        with mock.patch('gametracker.ingestion.save_game', return_value=(game, False)):
+            games, n_duplicates = import_replay_files([(paths[0], '4', GAME_DATA, '', '')])
+
+        self.assertEqual((games, n_duplicates), ([], 1))
+        self.assertFalse(GameReplay.objects.exists())
+        self.assertEqual(self.stored_replays(), stored)
+
+    def test_failed_batch(self):
+        """The replays copied by a failed batch are deleted"""
+        stored = self.stored_replays()
+        paths = self.replay_files("rec.20181018-203040.mgz", "rec.20181019-203040.mgz")
+
+        with mock.patch('gametracker.ingestion.save_game', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                import_replay_files([(path, str(i), GAME_DATA, '', '') for i, path in enumerate(paths)])
+
+        self.assertFalse(GameReplay.objects.exists())
+        self.assertEqual(self.stored_replays(), stored)
+
+
+class ReplayCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def image(self, name, data=b"png"):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_get(self):
+        """Cached game data are returned and the images are copied"""
+        cache = ReplayCache(os.path.join(self.directory, "cache"))
+        self.assertIsNone(cache.get("ab" * 32, "", ""))
+
+        cache.put("ab" * 32, GAME_DATA, self.image("minimap.png"), self.image("chronology.png"))
+
+        minimap = os.path.join(self.directory, "out", "minimap.png")
+        self.assertEqual(cache.get("ab" * 32, minimap, os.path.join(self.directory, "out", "chronology.png")),
+                         GAME_DATA)
+        with open(minimap, 'rb') as f:
+            self.assertEqual(f.read(), b"png")
+
+    def test_eviction(self):
+        """The least recently used replays are removed when the cache is full"""
+        cache = ReplayCache(os.path.join(self.directory, "cache"))
+        minimap = self.image("minimap.png", b"x" * 1000)
+
+        cache.put("a" * 64, GAME_DATA, minimap, "")
+        # Room for two replays
+        cache.max_size = cache.size * 5 // 2
+        os.utime(cache.path("a" * 64), (0, 0))
+        cache.put("b" * 64, GAME_DATA, minimap, "")
+        os.utime(cache.path("b" * 64), (1, 1))
+        out = os.path.join(self.directory, "out.png")
+        cache.get("a" * 64, out, "")
+        cache.put("c" * 64, GAME_DATA, minimap, "")
+
+        self.assertIsNotNone(cache.get("a" * 64, out, ""))
+        self.assertIsNone(cache.get("b" * 64, out, ""))
+        self.assertIsNotNone(cache.get("c" * 64, out, ""))
+
+    def test_parse_replay_file(self):
+        """The parser is not run for a cached replay"""
+        with self.settings(GAMETRACKER_REPLAY_CACHE={'DIRECTORY': os.path.join(self.directory, "cache")}), \
+                mock.patch('gametracker.ingestion.replay_parser') as replay_parser:
+            replay_parser.return_value.parse.return_value = GAME_DATA
+
+            self.assertEqual(parse_replay_file("rec.mgz", "cd" * 32)[0], GAME_DATA)
+            self.assertEqual(parse_replay_file("rec.mgz", "cd" * 32)[0], GAME_DATA)
+            self.assertEqual(replay_parser.return_value.parse.call_count, 1)
+
+
+class StubParser(ReplayParser):
+    """Parsing backend returning GAME_DATA, or failing depending on the file name"""
+    def parse(self, path, minimap_file, chronology_file):
+        if path == "crash":
+            os._exit(1)
+        elif path == "slow":
+            time.sleep(10)
+        elif path == "error":
+            raise ValueError("Invalid replay")
+
+        return dict(GAME_DATA, pid=os.getpid())
+
+
+class ParserServiceTest(TestCase):
+    def setUp(self):
+        self.service = ParserService('gametracker.tests.StubParser', workers=1, timeout=5)
+        self.addCleanup(self.service.close)
+
+    def test_parse(self):
+        """The same worker process parses all the replays"""
+        result = self.service.parse("rec.mgz", "minimap.png", "chronology.png")
+        self.assertEqual(result["map"], "Arabia")
+        self.assertEqual(self.service.parse("rec.mgz", "", "")["pid"], result["pid"])
+
+    def test_errors(self):
+        """A failing replay does not prevent the next ones from being parsed"""
+        pid = self.service.parse("rec.mgz", "", "")["pid"]
+
+        self.assertRaises(ReplayParserError, self.service.parse, "error", "", "")
+        self.assertEqual(self.service.parse("rec.mgz", "", "")["pid"], pid)
+
+        self.assertRaises(ReplayParserError, self.service.parse, "crash", "", "")
+        self.assertNotEqual(self.service.parse("rec.mgz", "", "")["pid"], pid)
+
+        self.assertRaises(ReplayParserTimeout, self.service.parse, "slow", "", "", timeout=0.5)
+        self.assertEqual(self.service.parse("rec.mgz", "", "")["map"], "Arabia")
+
+    def test_replace_from_thread(self):
+        """Workers crashing in the threads of the replay workers are replaced by the fork server"""
+        with ThreadPool(2) as pool:
+            with self.assertRaises(ReplayParserError):
+                pool.apply(self.service.parse, ("crash", "", ""))
+            result = pool.apply(self.service.parse, ("rec.mgz", "", ""))
+
+        self.assertEqual(result["map"], "Arabia")
+
+
 class TeamBalancerTest(TestCase):
+    def setUp(self):
+        # Ratings change without committing in tests, so balancing results of previous tests are removed
+        cache.clear()
+        balancing_cache().clear()
+
     def test_balancing_teams(self):
         elos = [2001, 1500, 2000, 1499]
         players = [factories.PersonFactory(init_elo=elo) for elo in elos]
@@ -263,6 +1115,224 @@ class TeamBalancerTest(TestCase):
 
         self.assertEqual(set(bteams[0]), set([players[0], players[-1]]))
 
+    def test_same_as_brute_force(self):
+        """Same teams as trying all the combinations, the first one in case of equality"""
+        random = Random(0)
+        for i in range(50):
+            elos = [random.choice([random.randint(1200, 2400), 1500]) for j in range(random.randint(2, 9))]
+            names = list(range(len(elos)))
+
+            for size in range(1, len(elos) // 2 + 1):
+                best = None
+                for team1 in itertools.combinations(names, size):
+                    team2 = [j for j in names if j not in team1]
+                    delta = abs(team_elo_formula([elos[j] for j in team1]) - team_elo_formula([elos[j] for j in team2]))
+                    if best is None or delta < best[0]:
+                        best = (delta, [list(team1), team2])
+
+                self.assertEqual(TeamBalancer(names, elos)._partition_players(size), best[1])
+
+    @skipIf(utils.numpy is None, "NumPy is not installed")
+    def test_score_splits(self):
+        """All the splits are scored at once like with the team elo formula"""
+        elos = [2000, 1800, 0, 1500]
+        sizes, deltas, probabilities = utils.score_splits(elos)
+
+        # Players 0 and 2 against players 1 and 3
+        mask = 0b0101
+        delta = team_elo_formula([2000]) - team_elo_formula([1800, 1500])
+        self.assertEqual((sizes[mask], deltas[mask]), (2, abs(delta)))
+        self.assertAlmostEqual(probabilities[mask], prob_winning(delta))
+
+        # No player with an elo in a team
+        self.assertEqual(deltas[0b0100], float('inf'))
+
+    @skipIf(utils.numpy is None, "NumPy is not installed")
+    def test_vectorized_same_as_meet_in_the_middle(self):
+        """Scoring all the splits gives the same teams as the other searches"""
+        random = Random(1)
+        for i in range(20):
+            elos = [random.choice([random.randint(1200, 2400), 1500, 0]) for j in range(random.randint(2, 10))]
+            balancer = TeamBalancer(list(range(len(elos))), elos)
+            self.assertTrue(balancer.vectorized())
+
+            with mock.patch('gametracker.utils.numpy', None):
+                expected = [balancer._best_split(size) for size in range(1, len(elos) // 2 + 1)]
+            self.assertEqual([balancer._best_split(size) for size in range(1, len(elos) // 2 + 1)], expected)
+
+        distribution = TeamBalancer(list(range(6)), [1500, 1600, 1700, 1800, 1900, 2000]).balance_distribution()
+        self.assertAlmostEqual(sum(percentage for low, high, percentage in distribution), 100)
+
+    def test_constrained_teams(self):
+        """Teams satisfy the constraints and are the most balanced ones"""
+        players = ["A", "B", "C", "D", "E", "F", "G"]
+        elos = [2400, 2000, 1900, 1600, 1500, 1450, 1200]
+        balancer = TeamBalancer(players, elos)
+
+        teams = balancer.get_constrained_teams(together=[("A", "G")], apart=[("B", "C")], pinned={"D": 1},
+                                               sizes=[3, 4])
+        self.assertIn("G", teams[0 if "A" in teams[0] else 1])
+        self.assertNotEqual("B" in teams[0], "C" in teams[0])
+        self.assertIn("D", teams[1])
+        self.assertIn(len(teams[0]), (3, 4))
+
+        # Same result as trying all the splits
+        best = None
+        for size in (3, 4):
+            for team1 in itertools.combinations(players, size):
+                if ("A" in team1) == ("G" in team1) and ("B" in team1) != ("C" in team1) and "D" not in team1:
+                    team2 = [p for p in players if p not in team1]
+                    delta = abs(team_elo_formula([elos[players.index(p)] for p in team1]) -
+                                team_elo_formula([elos[players.index(p)] for p in team2]))
+                    best = delta if best is None else min(best, delta)
+
+        delta = abs(team_elo_formula([elos[players.index(p)] for p in teams[0]]) -
+                    team_elo_formula([elos[players.index(p)] for p in teams[1]]))
+        self.assertEqual(delta, best)
+
+        self.assertIsNone(balancer.get_constrained_teams(together=[("A", "B")], apart=[("A", "B")]))
+        self.assertIsNone(balancer.get_constrained_teams(pinned={"A": 0, "B": 1}, together=[("A", "B")]))
+
+    def test_constrained_teams_view(self):
+        """Constraints are given by the names of the players"""
+        persons = [factories.PersonFactory(name=name, init_elo=elo)
+                   for name, elo in (("Foo", 2000), ("Bar", 1900), ("Baz", 1500), ("Qux", 1400))]
+
+        response = self.client.post(reverse('gametracker:balance_teams'),
+                                    {'players': [p.pk for p in persons], 'together': "foo+Bar", 'team2': "Qux"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.context['team1']), set(persons[:2]))
+        self.assertEqual(set(response.context['team2']), set(persons[2:]))
+
+        response = self.client.post(reverse('gametracker:balance_teams'),
+                                    {'players': [p.pk for p in persons], 'apart': "Foo+Nobody"})
+        self.assertIn('apart', response.context['form'].errors)
+
+    def test_best_splits(self):
+        """The k best splits are the first ones of all the splits sorted by difference"""
+        random = Random(2)
+        for i in range(20):
+            elos = [random.choice([random.randint(1200, 2400), 1500, 1600]) for j in range(random.randint(2, 9))]
+            names = list(range(len(elos)))
+
+            splits = []
+            for size in range(1, len(elos) // 2 + 1):
+                for team1 in itertools.combinations(names, size):
+                    # Each split once
+                    if 2 * size == len(elos) and 0 not in team1:
+                        continue
+                    team2 = [j for j in names if j not in team1]
+                    delta = abs(team_elo_formula([elos[j] for j in team1]) - team_elo_formula([elos[j] for j in team2]))
+                    splits.append((delta, size, team1))
+            expected = [(delta, team1) for delta, size, team1 in sorted(splits)[:5]]
+
+            self.assertEqual(list(TeamBalancer(names, elos).best_splits(5)), expected)
+            with mock.patch('gametracker.utils.numpy', None):
+                self.assertEqual(list(TeamBalancer(names, elos).best_splits(5)), expected)
+
+    def test_alternatives_view(self):
+        """Alternative teams are shown without balancing the teams again"""
+        persons = [factories.PersonFactory(init_elo=elo) for elo in (2000, 1900, 1500, 1400, 1300)]
+        response = self.client.post(reverse('gametracker:balance_teams'), {'players': [p.pk for p in persons]})
+        self.assertEqual(response.context['alternative'], 0)
+        teams = [set(response.context['team1']), set(response.context['team2'])]
+
+        with mock.patch('gametracker.views.TeamBalancer') as balancer:
+            response = self.client.get(reverse('gametracker:balance_teams'), {'alternative': 1})
+        self.assertFalse(balancer.called)
+        self.assertEqual(response.context['alternative'], 1)
+        self.assertNotIn(set(response.context['team1']), teams)
+        self.assertEqual(response.context['n_alternatives'], 10)
+
+    def test_cached_balancing(self):
+        """The same roster is only balanced once until ratings change"""
+        persons = [factories.PersonFactory(init_elo=elo) for elo in (2000, 1900, 1500, 1400)]
+        response = self.client.post(reverse('gametracker:balance_teams'), {'players': [p.pk for p in persons]})
+        teams = set(response.context['team1']), set(response.context['team2'])
+
+        with mock.patch('gametracker.views.TeamBalancer', wraps=TeamBalancer) as balancer:
+            response = self.client.post(reverse('gametracker:balance_teams'),
+                                        {'players': [p.pk for p in reversed(persons)]})
+            self.assertFalse(balancer.called)
+            self.assertEqual((set(response.context['team1']), set(response.context['team2'])), teams)
+
+            # Results are also shared with the other processes
+            balancing_cache().clear()
+            self.client.post(reverse('gametracker:balance_teams'), {'players': [p.pk for p in persons]})
+            self.assertFalse(balancer.called)
+
+            bump_rating_generation()
+            self.client.post(reverse('gametracker:balance_teams'), {'players': [p.pk for p in persons]})
+            self.assertTrue(balancer.called)
+
+            # Ratings recomputed by a replay worker, which does not share the cache of this process
+            balancer.reset_mock()
+            with mock.patch('gametracker.ratings.cache', LocMemCache('worker', {})):
+                update_elo()
+            self.client.post(reverse('gametracker:balance_teams'), {'players': [p.pk for p in persons]})
+            self.assertTrue(balancer.called)
+
+    def test_lru_cache(self):
+        lru = LRUCache(2)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.put("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+        self.assertEqual(len(lru), 2)
+
+    def test_many_players(self):
+        """Teams of 24 players are balanced"""
+        elos = [1200 + 50 * i for i in range(24)]
+        teams = TeamBalancer(list(range(24)), elos).get_balanced_teams()
+
+        delta = team_elo_formula([elos[i] for i in teams[0]]) - team_elo_formula([elos[i] for i in teams[1]])
+        self.assertEqual((len(teams[0]), delta), (12, 0))
+
+    def test_multiple_matches(self):
+        """40 players are split in 5 balanced matches within the time budget"""
+        random = Random(3)
+        elos = [random.randint(1200, 2400) for i in range(40)]
+
+        start = time.perf_counter()
+        balancing = MultiTeamBalancer(list(range(40)), elos).balance_matches(5)
+        self.assertLess(time.perf_counter() - start, 0.2)
+
+        players = [player for team1, team2 in balancing.teams for player in team1 + team2]
+        self.assertEqual(sorted(players), list(range(40)))
+        self.assertEqual({(len(team1), len(team2)) for team1, team2 in balancing.teams}, {(4, 4)})
+
+        worst = max(abs(team_elo_formula([elos[i] for i in team1]) - team_elo_formula([elos[i] for i in team2]))
+                    for team1, team2 in balancing.teams)
+        self.assertEqual(balancing.cost, worst)
+        self.assertEqual(balancing.gap, balancing.cost - balancing.lower_bound)
+        self.assertLess(balancing.cost, 5)
+
+    def test_multiple_teams(self):
+        """Teams of the same size, and the best split for a single match"""
+        elos = [1200 + 100 * i for i in range(9)]
+        balancing = MultiTeamBalancer(list(range(9)), elos).balance_teams(3)
+        self.assertEqual([len(team) for team in balancing.teams], [3, 3, 3])
+        self.assertEqual((balancing.cost, balancing.gap), (0, 0))
+
+        elos = [2001, 1500, 2000, 1499]
+        balancing = MultiTeamBalancer(list(range(4)), elos).balance_matches(1)
+        self.assertEqual({frozenset(team) for team in balancing.teams[0]}, {frozenset([0, 3]), frozenset([1, 2])})
+        self.assertEqual(balancing.gap, 0)
+
+        self.assertRaises(ValueError, MultiTeamBalancer(list(range(3)), elos[:3]).balance_matches, 2)
+
+    def test_multiple_matches_view(self):
+        persons = [factories.PersonFactory(init_elo=1200 + 100 * i) for i in range(8)]
+        response = self.client.post(reverse('gametracker:balance_teams'),
+                                    {'players': [p.pk for p in persons], 'n_matches': 2})
+        self.assertEqual(len(response.context['matches']), 2)
+        self.assertIn('gap', response.context)
+
+        response = self.client.post(reverse('gametracker:balance_teams'),
+                                    {'players': [p.pk for p in persons], 'n_matches': 5})
+        self.assertIn('n_matches', response.context['form'].errors)
+
 
 # Test views
 #class TestViews(TestCase):
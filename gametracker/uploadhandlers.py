@@ -0,0 +1,47 @@
+import hashlib
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Compute the SHA-256 of the uploaded files while they are received. Must come before the handlers
+    actually storing the files in FILE_UPLOAD_HANDLERS.
+    """
+    def __init__(self, *args, **kwargs):
+        super(HashingUploadHandler, self).__init__(*args, **kwargs)
+        self.digests = {}
+
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = self.sha256.hexdigest()
+        return None
+
+
+def sha256sum(f):
+    """SHA-256 of a file object"""
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: f.read(64 * 1024), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def uploaded_file_sha256(request, field_name):
+    """SHA-256 of an uploaded file, computed during the upload when HashingUploadHandler is enabled"""
+    for handler in request.upload_handlers:
+        if isinstance(handler, HashingUploadHandler) and field_name in handler.digests:
+            return handler.digests[field_name]
+
+    uploaded_file = request.FILES[field_name]
+    sha256 = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        sha256.update(chunk)
+    uploaded_file.seek(0)
+    return sha256.hexdigest()
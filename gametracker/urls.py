@@ -8,11 +8,18 @@ urlpatterns = [
     url(r'^$', views.index, name='index0'),
     url(r'^index$', views.index, name='index'),
     url(r'^addgame$', views.add_game, name="add_game"),
+    url(r'^addgame/(?P<pk>[0-9]+)$', views.replay_job, name="replay_job"),
     url(r'^creategame$', views.manually_add_game, name="manually_add_game"),
     url(r'^players$', views.person_list, name='players'),
+    url(r'^players/past$', views.past_leaderboard, name='past_leaderboard'),
+    url(r'^players/past\.json$', views.past_leaderboard_json, name='past_leaderboard_json'),
+    url(r'^player/(?P<person_name>.+)/elo\.json$', views.person_elo_json, name='player_elo'),
     url(r'^player/(?P<person_name>.+$)', views.person_detail, name='player'),
     url(r'^games$', views.HistoryView.as_view(), name='history'),
+    url(r'^games\.json$', views.history_json, name='history_json'),
     url(r'^game/(?P<pk>[0-9]+)$', views.game_detail, name='game'),
+    url(r'^stats$', views.stats, name='stats'),
+    url(r'^stats\.json$', views.stats_json, name='stats_json'),
     url(r'^teams$', views.balance_teams, name='balance_teams'),
     url(r'^build-orders$', views.build_orders, name='build_orders'),
     url(r'^update$', views.update, name='update'),
@@ -1,65 +1,634 @@
 import math
+import time
+import heapq
+import bisect
+import random
 import itertools
 import subprocess
 import sys
 
+from collections import namedtuple
+
+from gametracker.ratings import rating_snapshot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Corrective factor for multiplayer teams
+MP_FACTOR = 300
+
+# Rosters up to this size are balanced by scoring all the splits at once, if NumPy is installed
+MAX_VECTORIZED_PLAYERS = 18
+
+# Seconds spent improving the teams of large rosters
+BALANCING_TIME_BUDGET = 0.15
+
+# Bounds (in %) of the winning probability of the stronger team, for the distribution of the splits
+BALANCE_BINS = (50, 55, 60, 70, 80, 90, 100)
+
 
 class TeamBalancer:
-    """Create two balanced teams from a list of players"""
-    def __init__(self, players):
-        self.players = players
+    """
+    Create two balanced teams from a list of players. Teams are searched on the elos of the players:
+    the subsets of the first half of the players are matched with the subsets of the second half
+    (meet in the middle), which gives the same teams as trying all the combinations.
+    """
+    def __init__(self, players, elos=None):
+        self.players = list(players)
+        self.elos = list(elos) if elos is not None else player_elos(self.players)
+        self.total = sum(elo for elo in self.elos if elo)
+        self.half = len(self.players) // 2
+        self._subsets = None
+        self._scores = None
 
-    def _partition_players(self, size):
-        """Split players in two teams: one of size 'size' and the other of size N - 'size'"""
-        min_delta = None
-        teams = []
+    def vectorized(self):
+        """Whether all the splits are scored at once"""
+        return numpy is not None and len(self.elos) <= MAX_VECTORIZED_PLAYERS
+
+    def scores(self):
+        """Scores of all the splits, see score_splits"""
+        if self._scores is None:
+            self._scores = score_splits(self.elos)
+        return self._scores
+
+    def _half_subsets(self):
+        """
+        Subsets of the first half of the players by size, as (sum of elos, indexes) in lexicographic order,
+        and subsets of the second half by size, as the sorted sums of elos and the subsets of each sum
+        """
+        if self._subsets is None:
+            n = len(self.elos)
+            first = [[(sum(self.elos[i] for i in indexes), indexes)
+                      for indexes in itertools.combinations(range(self.half), size)]
+                     for size in range(self.half + 1)]
+
+            second = []
+            for size in range(n - self.half + 1):
+                subsets = {}
+                for indexes in itertools.combinations(range(self.half, n), size):
+                    subsets.setdefault(sum(self.elos[i] for i in indexes), []).append(indexes)
+                second.append((sorted(subsets), subsets))
+
+            self._subsets = first, second
+        return self._subsets
+
+    def _delta(self, total1, size):
+        """Elo difference between a team of 'size' players whose elos sum to 'total1' and the other players"""
+        n = len(self.elos)
+        return abs(team_elo_from_sum(total1, size) - team_elo_from_sum(self.total - total1, n - size))
+
+    def best_splits(self, k=1, sizes=None):
+        """
+        Generate the 'k' most balanced splits as (elo difference, indexes of the first team), from a single
+        search. 'sizes' are the allowed sizes of the first team, up to half of the players by default.
+        Splits are ordered by difference, then size of the first team, then combination. When both teams
+        have the same size, each split is given once, with the first player in the first team.
+        """
+        n = len(self.elos)
+        sizes = sorted(set(range(1, n // 2 + 1) if sizes is None else sizes))
+        best = BestSplits(k)
+
+        if self.vectorized():
+            self._vectorized_splits(best, sizes)
+        elif not all(self.elos):
+            self._brute_force_splits(best, sizes)
+        else:
+            self._meet_in_the_middle_splits(best, sizes)
+
+        for split in best:
+            yield split
+
+    def _meet_in_the_middle_splits(self, best, sizes):
+        n = len(self.elos)
+        first, second = self._half_subsets()
+
+        for size in sizes:
+            # The difference increases with the elos of the first team: it is zero for this sum
+            target = balance_point(self.total, n, size)
+
+            for size1 in range(max(0, size - (n - self.half)), min(size, self.half) + 1):
+                sums, subsets = second[size - size1]
+
+                for total1, indexes1 in first[size1]:
+                    if 2 * size == n and indexes1[:1] != (0,):
+                        continue
+
+                    # Sums further from the target give larger differences, in both directions
+                    i = bisect.bisect_left(sums, target - total1)
+                    for direction in (range(i - 1, -1, -1), range(i, len(sums))):
+                        for j in direction:
+                            delta = self._delta(total1 + sums[j], size)
+                            if delta > best.worst():
+                                break
+
+                            # Subsets are in lexicographic order: the next ones are not kept either
+                            for indexes2 in subsets[sums[j]]:
+                                if not best.push(delta, indexes1 + indexes2):
+                                    break
+
+    def _vectorized_splits(self, best, sizes):
+        """Same as _meet_in_the_middle_splits, from the scores of all the splits"""
+        n = len(self.elos)
+        team_sizes, deltas, probabilities = self.scores()
 
-        # Explore all combinations with 1st group of size 'size'
-        for players in itertools.combinations(self.players, size):
-            team1 = list(set(players))
-            team2 = list(set(self.players) - set(players))
+        selected = numpy.isin(team_sizes, sizes) & numpy.isfinite(deltas)
+        if 2 * (n // 2) == n:
+            selected &= (team_sizes != n // 2) | (numpy.arange(len(deltas)) & 1 == 1)
+        masks = numpy.flatnonzero(selected)
 
-            diff = abs(calc_team_elo(team1) - calc_team_elo(team2))
+        # Only the splits at most as unbalanced as the k-th one can be kept
+        if len(masks) > best.k:
+            kth = numpy.partition(deltas[masks], best.k - 1)[best.k - 1]
+            masks = masks[deltas[masks] <= kth]
 
-            if min_delta is None or diff < min_delta:
-                teams = [team1, team2]
-                min_delta = diff
+        for mask in masks:
+            best.push(float(deltas[mask]), tuple(i for i in range(n) if mask >> i & 1))
 
-        return teams
+    def _brute_force_splits(self, best, sizes):
+        """Same as _meet_in_the_middle_splits, trying all the combinations. Used when some players have no elo"""
+        n = len(self.elos)
+
+        for size in sizes:
+            for indexes in itertools.combinations(range(n), size):
+                if 2 * size == n and indexes[0] != 0:
+                    continue
+
+                # Players without elo are not taken into account in the team elo
+                team1 = [self.elos[i] for i in indexes if self.elos[i]]
+                team2 = [elo for i, elo in enumerate(self.elos) if elo and i not in indexes]
+
+                if team1 and team2:
+                    best.push(abs(team_elo_formula(team1) - team_elo_formula(team2)), indexes)
+
+    def _best_split(self, size):
+        """
+        Returns the smallest elo difference with 'size' players in the first team, and the indexes
+        of these players. The first combination is returned if several ones give the same difference.
+        """
+        return next(self.best_splits(1, [size]), (math.inf, tuple(range(size))))
+
+    def split_teams(self, indexes):
+        """The players of the given indexes, and the other players"""
+        indexes = set(indexes)
+        return [[player for i, player in enumerate(self.players) if i in indexes],
+                [player for i, player in enumerate(self.players) if i not in indexes]]
+
+    def _partition_players(self, size):
+        """Split players in two teams: one of size 'size' and the other of size N - 'size'"""
+        delta, indexes = self._best_split(size)
+        return self.split_teams(indexes)
 
     def get_teams(self):
         """Return the most balanced teams according to the algorithm"""
-        s_teams = [self._partition_players(size) for size in range(1, len(self.players) // 2 + 1)]
-        deltas = [abs(calc_team_elo(couple[0]) - calc_team_elo(couple[1])) for couple in s_teams]
-        return s_teams[deltas.index(min(deltas))]
+        delta, indexes = next(self.best_splits(1), (math.inf, (0,)))
+        return self.split_teams(indexes)
 
     def get_balanced_teams(self):
         """Return the most balanced teams with a similar number of players in both teams"""
         return self._partition_players(len(self.players) // 2)
 
+    def get_constrained_teams(self, together=(), apart=(), pinned=None, sizes=None):
+        """
+        Return the most balanced teams satisfying constraints on the players: pairs of players playing
+        together or against each other, players pinned to a team ({player: 0 or 1}) and allowed sizes
+        of the first team. Returns None if no teams satisfy the constraints.
+        """
+        for delta, indexes in self.best_constrained_splits(1, together, apart, pinned, sizes):
+            return self.split_teams(indexes)
+        return None
+
+    def best_constrained_splits(self, k=1, together=(), apart=(), pinned=None, sizes=None):
+        """'k' most balanced splits satisfying the constraints, as (elo difference, indexes of the first team)"""
+        index = {player: i for i, player in enumerate(self.players)}
+        return constrained_splits(self.elos, k,
+                                  together=[(index[a], index[b]) for a, b in together],
+                                  apart=[(index[a], index[b]) for a, b in apart],
+                                  pinned={index[player]: side for player, side in (pinned or {}).items()},
+                                  sizes=sizes)
+
+    def win_probabilities(self, size=None):
+        """
+        Probabilities of winning of the team of the first player, for all the splits (with 'size' players
+        in one of the teams if given). None if the splits are not scored at once.
+        """
+        if not self.vectorized():
+            return None
+
+        sizes, deltas, probabilities = self.scores()
+
+        # Each split once, with the first player in the first team
+        selected = (numpy.arange(len(sizes)) & 1 == 1) & numpy.isfinite(deltas)
+        if size is not None:
+            selected &= (sizes == size) | (sizes == len(self.elos) - size)
+
+        return probabilities[selected]
+
+    def balance_distribution(self, size=None, bins=BALANCE_BINS):
+        """
+        Distribution of the splits according to the probability of winning of the stronger team,
+        as a list of (lower bound, upper bound, % of the splits). None if the splits are not scored at once.
+        """
+        probabilities = self.win_probabilities(size)
+        if probabilities is None or not len(probabilities):
+            return None
+
+        stronger = numpy.maximum(probabilities, 1 - probabilities) * 100
+        counts, edges = numpy.histogram(stronger, bins=bins)
+        return [(low, high, float(count * 100 / len(stronger))) for low, high, count in zip(bins, bins[1:], counts)]
+
+
+def balance_point(total, n, size):
+    """Sum of the elos of a team of 'size' players, out of 'n' players, for which both teams have the same elo"""
+    return ((total / (n - size) + MP_FACTOR * (math.log(n - size, 2) - math.log(size, 2))) /
+            (1 / size + 1 / (n - size)))
+
+
+class BestSplits:
+    """Bounded heap keeping the 'k' best splits, as (elo difference, indexes of the first team)"""
+    def __init__(self, k):
+        self.k = max(1, k)
+        self.heap = []
+
+    def worst(self):
+        """Difference of the worst split kept, infinite while less than 'k' splits are kept"""
+        return -self.heap[0][0] if len(self.heap) >= self.k else math.inf
+
+    def push(self, delta, indexes):
+        """Keep a split if it is better than the worst one. Returns whether it was kept"""
+        # Inverted key: the top of the heap is the worst split
+        key = (-delta, -len(indexes), tuple(-i for i in indexes))
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, key)
+        elif key > self.heap[0]:
+            heapq.heapreplace(self.heap, key)
+        else:
+            return False
+        return True
+
+    def __iter__(self):
+        """Splits from the best one"""
+        for delta, size, indexes in sorted(self.heap, reverse=True):
+            yield -delta, tuple(-i for i in indexes)
+
+
+def constrained_split(elos, together=(), apart=(), pinned=None, sizes=None):
+    """
+    Most balanced split of the players satisfying the constraints. Returns the elo difference and the
+    indexes of the first team, or None if there is no split. See constrained_splits.
+    """
+    splits = constrained_splits(elos, 1, together, apart, pinned, sizes)
+    return splits[0] if splits else None
+
+
+def constrained_splits(elos, k=1, together=(), apart=(), pinned=None, sizes=None):
+    """
+    'k' most balanced splits of the players satisfying the constraints, found by branch and bound. Players
+    are given by their index: 'together' and 'apart' are pairs of players, 'pinned' maps players to their
+    team (0 for the first team, 1 for the second) and 'sizes' are the allowed sizes of the first team (all
+    by default). Returns a list of (elo difference, indexes of the first team), from the best split.
+    """
+    n = len(elos)
+    elos = [elo or 0 for elo in elos]
+    pinned = pinned or {}
+    sizes = sorted(size for size in set(range(1, n) if sizes is None else sizes) if 0 < size < n)
+
+    # Players always playing together form a group
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i, j in together:
+        parent[find(i)] = find(j)
+
+    members = {}
+    for i in range(n):
+        members.setdefault(find(i), []).append(i)
+
+    # Groups with the highest elos are placed first, so that the bounds are tight early
+    groups = sorted(members.values(), key=lambda group: (-sum(elos[i] for i in group), group))
+    group_index = {i: g for g, group in enumerate(groups) for i in group}
+
+    sides = []
+    for group in groups:
+        group_sides = set(pinned[i] for i in group if i in pinned)
+        if len(group_sides) > 1:
+            return []
+        sides.append(group_sides.pop() if group_sides else None)
+
+    opponents = [set() for group in groups]
+    for i, j in apart:
+        if group_index[i] == group_index[j]:
+            return []
+        opponents[group_index[i]].add(group_index[j])
+        opponents[group_index[j]].add(group_index[i])
+
+    if not sizes or not groups:
+        return []
+
+    # Without pinned players, both teams can be swapped: the first group is put in the first team
+    if not pinned and all(n - size in sizes for size in sizes):
+        sides[0] = 0
+
+    # Sums of the 'm' lowest and highest elos of the players not placed yet, before each group
+    lowest, highest = [], []
+    for g in range(len(groups) + 1):
+        remaining = sorted(elos[i] for group in groups[g:] for i in group)
+        lowest.append(list(itertools.accumulate([0] + remaining)))
+        highest.append(list(itertools.accumulate([0] + remaining[::-1])))
+
+    total = sum(elos)
+    all_rated = all(elos)
+    integers = all(isinstance(elo, int) for elo in elos)
+
+    def difference(total1, size):
+        return team_elo_from_sum(total1, size) - team_elo_from_sum(total - total1, n - size)
+
+    def lower_bound(g, total1, n1, n2):
+        """Smallest possible difference once all the players are placed"""
+        bound = math.inf
+        for size in sizes:
+            m = size - n1
+            if m < 0 or m > n - n1 - n2:
+                continue
+            elif not all_rated:
+                return 0
+
+            # The difference increases with the elos of the first team
+            low_total, high_total = total1 + lowest[g][m], total1 + highest[g][m]
+            low, high = difference(low_total, size), difference(high_total, size)
+
+            if low <= 0 <= high:
+                if not integers:
+                    return 0
+
+                # Sums of elos are integers: the closest ones to the balance point give the smallest difference
+                target = balance_point(total, n, size)
+                closest = (min(max(math.floor(target), low_total), high_total),
+                           min(max(math.ceil(target), low_total), high_total))
+                bound = min(bound, *(abs(difference(total1, size)) for total1 in closest))
+            else:
+                bound = min(bound, abs(low), abs(high))
+
+        return bound
+
+    best = BestSplits(k)
+    placed = [None] * len(groups)
+
+    def search(g, totals, counts, rated):
+        if g == len(groups):
+            if counts[0] in sizes and rated[0] and rated[1]:
+                delta = abs(team_elo_from_sum(totals[0], rated[0]) - team_elo_from_sum(totals[1], rated[1]))
+                best.push(delta, tuple(sorted(i for h, group in enumerate(groups) if placed[h] == 0 for i in group)))
+            return
+
+        if lower_bound(g, totals[0], counts[0], counts[1]) >= best.worst():
+            return
+
+        group = groups[g]
+        group_total = sum(elos[i] for i in group)
+        group_rated = sum(1 for i in group if elos[i])
+
+        for side in (0, 1):
+            if sides[g] not in (None, side) or any(placed[h] == side for h in opponents[g]):
+                continue
+
+            placed[g] = side
+            totals[side] += group_total
+            counts[side] += len(group)
+            rated[side] += group_rated
+
+            search(g + 1, totals, counts, rated)
+
+            totals[side] -= group_total
+            counts[side] -= len(group)
+            rated[side] -= group_rated
+            placed[g] = None
+
+    search(0, [0, 0], [0, 0], [0, 0])
+    return list(best)
+
+
+def score_splits(elos):
+    """
+    Score all the splits of the players with NumPy. Split 'mask' puts player i in the first team if bit i
+    of 'mask' is set. Returns the number of players of the first team, the elo difference between the teams
+    (infinite if a team has no player with an elo) and the probability of winning of the first team,
+    as arrays indexed by the mask. Gives the same differences as team_elo_formula.
+    """
+    n = len(elos)
+    elos = [elo or 0 for elo in elos]
+
+    # Number of players, number of players with an elo and sum of elos of each mask
+    sizes = numpy.zeros(1, dtype=numpy.int64)
+    rated = numpy.zeros(1, dtype=numpy.int64)
+    sums = numpy.zeros(1, dtype=numpy.int64)
+    for elo in elos:
+        sizes = numpy.concatenate((sizes, sizes + 1))
+        rated = numpy.concatenate((rated, rated + bool(elo)))
+        sums = numpy.concatenate((sums, sums + elo))
+
+    # The other team is given by the complementary mask
+    rated2 = rated[::-1]
+    sums2 = sums[::-1]
+
+    # Same corrective factors as team_elo_formula
+    factors = numpy.array([0.0] + [MP_FACTOR * math.log(k, 2) for k in range(1, n + 1)])
+
+    valid = (rated > 0) & (rated2 > 0)
+    elo1 = sums / numpy.maximum(rated, 1) + factors[rated]
+    elo2 = sums2 / numpy.maximum(rated2, 1) + factors[rated2]
+
+    differences = numpy.where(valid, elo1 - elo2, 0.0)
+    deltas = numpy.where(valid, numpy.abs(differences), numpy.inf)
+
+    return sizes, deltas, prob_winning(differences)
+
+
+# Result of MultiTeamBalancer: teams (or matches as pairs of teams) of players, balance of the teams,
+# lower bound of the best possible balance and difference between both
+Balancing = namedtuple('Balancing', ['teams', 'cost', 'lower_bound', 'gap'])
+
+
+class MultiTeamBalancer:
+    """
+    Split a large roster in several teams, or in several matches of two teams. Players are dealt to the teams
+    in snake order of elo, then pairs of players are swapped between teams while it improves the balance.
+    The search restarts from perturbed teams until the time budget is spent, and keeps the best teams found.
+    """
+    def __init__(self, players, elos=None, seed=0):
+        self.players = list(players)
+        self.elos = [elo or 0 for elo in (elos if elos is not None else player_elos(self.players))]
+        self.random = random.Random(seed)
+
+    def balance_teams(self, n_teams, time_budget=BALANCING_TIME_BUDGET):
+        """Split the players in 'n_teams' teams. The balance is the difference between the best and worst team"""
+        return self._search(n_teams, False, time_budget)
+
+    def balance_matches(self, n_matches, time_budget=BALANCING_TIME_BUDGET):
+        """Split the players in 'n_matches' matches. The balance is the largest difference in a match"""
+        return self._search(2 * n_matches, True, time_budget)
+
+    def _search(self, n_teams, matches, time_budget):
+        deadline = time.perf_counter() + time_budget
+        n = len(self.players)
+        if n_teams < 2 or n < n_teams:
+            raise ValueError("Pas assez de joueurs pour {} équipes".format(n_teams))
+
+        # Snake draft, from the best player
+        order = sorted(range(n), key=lambda i: -self.elos[i])
+        assignment = [0] * n
+        for rank, i in enumerate(order):
+            turn, position = divmod(rank, n_teams)
+            assignment[i] = position if turn % 2 == 0 else n_teams - 1 - position
+
+        best = self._local_search(assignment, n_teams, matches, deadline)
+        best_cost = self._cost(best, n_teams, matches)
+        lower_bound = self._lower_bound(n_teams, matches)
+
+        # Restart from the best teams with a few random swaps, until the teams can't be better
+        while best_cost[0] > lower_bound and time.perf_counter() < deadline:
+            assignment = list(best)
+            for k in range(self.random.randint(2, 4)):
+                i, j = self.random.sample(range(n), 2)
+                assignment[i], assignment[j] = assignment[j], assignment[i]
+
+            assignment = self._local_search(assignment, n_teams, matches, deadline)
+            cost = self._cost(assignment, n_teams, matches)
+            if cost < best_cost:
+                best, best_cost = assignment, cost
+
+        teams = [[player for player, team in zip(self.players, best) if team == t] for t in range(n_teams)]
+        if matches:
+            teams = [(teams[t], teams[t + 1]) for t in range(0, n_teams, 2)]
+
+        return Balancing(teams, best_cost[0], lower_bound, best_cost[0] - lower_bound)
+
+    def _team_elos(self, assignment, n_teams):
+        totals, rated = [0] * n_teams, [0] * n_teams
+        for team, elo in zip(assignment, self.elos):
+            totals[team] += elo
+            rated[team] += bool(elo)
+        return [team_elo_from_sum(total, count) if count else -math.inf for total, count in zip(totals, rated)]
+
+    def _cost(self, assignment, n_teams, matches):
+        """Balance of the teams, compared lexicographically: (largest difference, sum of the differences)"""
+        return self._cost_from_elos(self._team_elos(assignment, n_teams), matches)
+
+    @staticmethod
+    def _cost_from_elos(team_elos, matches):
+        if matches:
+            differences = [abs(team_elos[t] - team_elos[t + 1]) for t in range(0, len(team_elos), 2)]
+            return max(differences), sum(differences)
+
+        return max(team_elos) - min(team_elos), 0
+
+    def _local_search(self, assignment, n_teams, matches, deadline):
+        """Swap players of different teams while it improves the balance"""
+        assignment = list(assignment)
+        n = len(assignment)
+
+        totals, rated = [0] * n_teams, [0] * n_teams
+        for team, elo in zip(assignment, self.elos):
+            totals[team] += elo
+            rated[team] += bool(elo)
+
+        def team_elo(t):
+            return team_elo_from_sum(totals[t], rated[t]) if rated[t] else -math.inf
+
+        team_elos = [team_elo(t) for t in range(n_teams)]
+        cost = self._cost_from_elos(team_elos, matches)
+
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+
+            for i in range(n):
+                for j in range(i + 1, n):
+                    a, b = assignment[i], assignment[j]
+                    if a == b or self.elos[i] == self.elos[j]:
+                        continue
+
+                    # Swap i and j, and only update the elo of their teams
+                    delta = self.elos[j] - self.elos[i]
+                    delta_rated = bool(self.elos[j]) - bool(self.elos[i])
+                    totals[a] += delta
+                    totals[b] -= delta
+                    rated[a] += delta_rated
+                    rated[b] -= delta_rated
+                    elo_a, elo_b = team_elos[a], team_elos[b]
+                    team_elos[a], team_elos[b] = team_elo(a), team_elo(b)
+
+                    new_cost = self._cost_from_elos(team_elos, matches)
+                    if new_cost < cost:
+                        assignment[i], assignment[j] = b, a
+                        cost = new_cost
+                        improved = True
+                    else:
+                        totals[a] -= delta
+                        totals[b] += delta
+                        rated[a] -= delta_rated
+                        rated[b] += delta_rated
+                        team_elos[a], team_elos[b] = elo_a, elo_b
+
+        return assignment
+
+    def _lower_bound(self, n_teams, matches):
+        """
+        Lower bound of the best possible balance: exact for a single match of a roster small enough,
+        otherwise from the sums of elos, which are integers
+        """
+        n = len(self.players)
+        sizes = set(n // n_teams + (t < n % n_teams) for t in range(n_teams))
+        if not all(self.elos) or not all(isinstance(elo, int) for elo in self.elos):
+            return 0
+        elif matches and n_teams == 2 and n <= 24:
+            balancer = TeamBalancer(self.players, self.elos)
+            return next(balancer.best_splits(1, [n // 2]))[0]
+        elif not matches and len(sizes) == 1 and sum(self.elos) % n_teams:
+            # Teams of the same size can't all have the same sum of elos
+            return 1 / sizes.pop()
+        return 0
+
+
+def player_elos(players):
+    """Elo of persons or players, without querying the database for each of them"""
+    snapshot = rating_snapshot()
+    return [snapshot.elo(player) for player in players]
+
 
 def calc_team_elo(team):
-    """Calculate elo rating for a team"""
+    """Calculate elo rating for a team of persons or players"""
+    snapshot = rating_snapshot()
     elos = []
     for player in team:
-        if player.get_elo():
-            elos.append(player.get_elo())
+        elo = snapshot.elo(player)
+        if elo:
+            elos.append(elo)
         # If a player has no elo, he is not taken into account in the team elo
         else:
-            print("WARNING: no elo for player '" + player.identity.pseudo + "' !")
+            print("WARNING: no elo for player '" + str(player) + "' !")
 
     return team_elo_formula(elos)
 
 
 def team_elo_formula(elos):
     """Team elo formula"""
-    # Corrective factor for multiplayer teams
-    MP_FACTOR = 300
-
     if not elos:
         return None
 
-    return sum(elos) / len(elos) + MP_FACTOR * math.log(len(elos), 2)
+    return team_elo_from_sum(sum(elos), len(elos))
+
+
+def team_elo_from_sum(total, n):
+    """Team elo formula, from the sum of the elos of the 'n' players"""
+    return total / n + MP_FACTOR * math.log(n, 2)
 
 
 def prob_winning(delta_elo):
@@ -67,10 +636,52 @@ def prob_winning(delta_elo):
     return 1 / (1 + 10**(-delta_elo / 250))
 
 
+def elo_increment(delta_elo, winner=True):
+    """Returns the (unrounded) elo variation given the elo difference"""
+    K = 20
+    return K * (int(winner) - prob_winning(delta_elo))
+
+
 def calculate_new_elo(elo, delta_elo, winner=True):
     """Returns the new elo given the former elo and the elo difference"""
-    K = 20
-    return round(elo + K * (int(winner) - prob_winning(delta_elo)))
+    return round(elo + elo_increment(delta_elo, winner))
+
+
+def downsample(xs, ys, n_points):
+    """
+    Indexes of 'n_points' points of a series which keep its shape, with the Largest-Triangle-Three-Buckets
+    algorithm: the points are split in buckets, and the point of each bucket forming the largest triangle
+    with the point kept in the previous bucket and the average of the next bucket is kept.
+    The first and last points are always kept.
+    """
+    n = len(xs)
+    if n <= n_points or n_points < 3:
+        return list(range(n))
+
+    indexes = [0]
+    bucket_size = (n - 2) / (n_points - 2)
+    a = 0
+
+    for bucket in range(n_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        # Average of the next bucket (the last point for the last bucket)
+        next_start, next_end = end, min(int((bucket + 2) * bucket_size) + 1, n)
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        best, best_area = start, -1
+        for i in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[i] - ys[a]) - (xs[a] - xs[i]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = i, area
+
+        indexes.append(best)
+        a = best
+
+    indexes.append(n - 1)
+    return indexes
 
 
 def generate_identicon(name, output):
@@ -1,98 +1,329 @@
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
 from django.views import generic
-from django.utils import timezone
+from django.views.decorators.http import condition
+from django.utils import timezone, translation
+from django.utils.dateparse import parse_date
 from django.urls import reverse
 
-from gametracker.models import Game, Person, Identity, EloLog
-from gametracker.forms import GameForm, ReplayForm, TeamsForm
-from gametracker.utils import calc_team_elo, prob_winning, TeamBalancer
-from gametracker.signals import update_elo
+from gametracker.models import Game, GamePlayer, GameReplay, Person, Player, EloLog, ReplayJob
+from gametracker.forms import GameForm, HistoryFilterForm, PastLeaderboardForm, ReplayForm, StatsForm, TeamsForm
+from gametracker.history import filter_games, game_data, history_page
+from gametracker.leaderboard import RankMovement, leaderboard_at, rank_movements
+from gametracker.utils import calc_team_elo, downsample, prob_winning, TeamBalancer, MultiTeamBalancer
+from gametracker.ratings import balancing_cache, rating_state
+from gametracker.signals import update_elo, deferred_elo_update, request_elo_update
+from gametracker.stats import add_game as add_game_stats, civilization_stats, map_stats, matchup_stats
+from gametracker.uploadhandlers import uploaded_file_sha256
+
+
+# Number of teams proposed on the team balancing page
+N_ALTERNATIVES = 10
+
+# Default and maximal number of points of the elo history sent to the charts
+ELO_SERIES_POINTS = 200
+MAX_ELO_SERIES_POINTS = 2000
+
+# Seconds during which the leaderboard fragments are cached, for a given rating generation
+LEADERBOARD_CACHE_TIMEOUT = 24 * 3600
+
+
+def request_rating_state(request):
+    """Rating generation and time of the last change, read once per request"""
+    if not hasattr(request, 'rating_state'):
+        request.rating_state = rating_state()
+    return request.rating_state
+
+
+def leaderboard_etag(request, *args, **kwargs):
+    """The leaderboard only changes with ratings, and is translated"""
+    return "{}-{}".format(request_rating_state(request)[0], translation.get_language())
+
 
+def leaderboard_last_modified(request, *args, **kwargs):
+    return request_rating_state(request)[1]
 
+
+def leaderboard_context(request):
+    """
+    Context of the pages showing the leaderboard. Queries are lazy: they only run if the
+    leaderboard fragments are not cached for the current rating generation.
+    """
+    return {'person_list': Person.objects.order_by('-elo'),
+            'n_games': Game.objects.filter(ranked=True).count,
+            'rating_generation': request_rating_state(request)[0],
+            'cache_timeout': LEADERBOARD_CACHE_TIMEOUT}
+
+
+@condition(etag_func=leaderboard_etag, last_modified_func=leaderboard_last_modified)
 def index(request):
-    persons = Person.objects.order_by('-elo')
-    return render(request, "gametracker/index.html", {'person_list': persons})
+    return render(request, "gametracker/index.html", leaderboard_context(request))
 
 
+@condition(etag_func=leaderboard_etag, last_modified_func=leaderboard_last_modified)
 def person_list(request):
-    persons = Person.objects.order_by('-elo')
-    total_n_games = Game.objects.filter(ranked=True).count()
+    return render(request, 'gametracker/person_list.html', leaderboard_context(request))
+
+
+def past_leaderboard(request):
+    """Leaderboard at a past date, with the rank movements since another date"""
+    form = PastLeaderboardForm(request.GET or None)
+    context = {'form': form}
+
+    if form.is_valid():
+        context.update(past_leaderboard_context(form))
+
+    return render(request, 'gametracker/past_leaderboard.html', context)
+
+
+def past_leaderboard_json(request):
+    form = PastLeaderboardForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    context = past_leaderboard_context(form)
+    return JsonResponse({'date': form.cleaned_data['date'].isoformat(),
+                         'since': form.cleaned_data['since'].isoformat() if form.cleaned_data['since'] else None,
+                         'ranking': [dict(standing._asdict(), person=standing.person.name)
+                                     for standing in context['standings']]})
 
-    return render(request, 'gametracker/person_list.html', {'person_list': persons, "n_games": total_n_games})
+
+def past_leaderboard_context(form):
+    date, since = form.cleaned_data['date'], form.cleaned_data['since']
+
+    if since is not None:
+        standings = rank_movements(since, date)
+    else:
+        standings = [RankMovement(standing.rank, standing.person, standing.elo, None, None, None)
+                     for standing in leaderboard_at(date)]
+
+    return {'standings': standings, 'date': date, 'since': since}
+
+
+def stats(request):
+    """Win ratio of the civilizations, on all the maps or on one, and details of a civilization"""
+    form = StatsForm(request.GET or None)
+    context = stats_context(form)
+    context['form'] = form
+    return render(request, 'gametracker/stats.html', context)
+
+
+def stats_json(request):
+    form = StatsForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    context = stats_context(form)
+    return JsonResponse({'map': context['game_map'].name if context['game_map'] else None,
+                         'civilization': context['civilization'],
+                         'civilizations': [record._asdict() for record in context['civilizations']],
+                         'maps': [record._asdict() for record in context['maps']],
+                         'matchups': [record._asdict() for record in context['matchups']]})
+
+
+def stats_context(form):
+    """Statistics read from the materialized tables, whatever the number of games"""
+    game_map, civilization = None, None
+    if form.is_valid():
+        game_map, civilization = form.cleaned_data['game_map'], form.cleaned_data['civilization']
+
+    return {'game_map': game_map,
+            'civilization': civilization,
+            'civilizations': civilization_stats(game_map),
+            'maps': map_stats(civilization) if civilization else [],
+            'matchups': matchup_stats(civilization) if civilization else []}
 
 
 class HistoryView(generic.ListView):
+    """Games by pages, most recent first. The next pages are loaded from history_json while scrolling"""
     model = Game
     template_name = "gametracker/history.html"
+    context_object_name = "game_list"
 
     def get_queryset(self):
-        return Game.objects.order_by('-date').prefetch_related('team1', 'team2')
+        self.form = HistoryFilterForm(self.request.GET or None)
+        self.page = filtered_history_page(self.request, self.form)
+        return self.page.games
 
+    def get_context_data(self, **kwargs):
+        context = super(HistoryView, self).get_context_data(**kwargs)
 
-def person_detail(request, person_name):
-    person = get_object_or_404(Person, name__iexact=person_name)
+        # The next pages keep the filters
+        query = self.request.GET.copy()
+        query.pop('before', None)
 
-    (n_victories, n_defeats) = (0, 0)
-    identities = Identity.objects.filter(person=person)
+        context.update({'form': self.form, 'n_games': self.page.count, 'next_cursor': self.page.next_cursor,
+                        'filter_query': query.urlencode()})
+        return context
 
-    victories = [game for game in Game.objects.all() if game.winners().filter(identity__in=identities).exists()]
-    defeats = [game for game in Game.objects.all() if game.losers().filter(identity__in=identities).exists()]
 
-    n_victories = len(victories)
-    n_defeats = len(defeats)
+def history_json(request):
+    """A page of the game history, as data and as rows of the history table"""
+    page = filtered_history_page(request, HistoryFilterForm(request.GET))
 
-    games = victories + defeats
-    games.sort(key=lambda x: x.date)
+    return JsonResponse({'games': [game_data(game) for game in page.games],
+                         'next': page.next_cursor,
+                         'count': page.count,
+                         'html': render_to_string("gametracker/history_rows.html", {'game_list': page.games},
+                                                  request)})
 
 
+def filtered_history_page(request, form):
+    """The page of the history requested in the query string"""
+    try:
+        return history_page(filter_games(Game.objects.all(), **form.filters()), cursor=request.GET.get('before'))
+    except ValueError:
+        raise Http404("Page inconnue")
+
+
+def person_detail(request, person_name):
+    person = get_object_or_404(Person, name__iexact=person_name)
+
+    # All the games of the person, in one query on the GamePlayer index
+    games = list(GamePlayer.objects.filter(person=person).select_related('game', 'game_map').order_by('date'))
+
+    n_victories = sum(1 for game in games if game.won)
+    n_defeats = len(games) - n_victories
+
     try:
         victory_ratio = n_victories * 100.0 / (n_victories + n_defeats)
     except ZeroDivisionError:
         victory_ratio = 0
 
-    elo_history = EloLog.objects.filter(person__pk=person.pk).order_by('date')
-    elos = [elolog.elo for elolog in elo_history]
-
+    # The elo history is loaded by the chart, from person_elo_json
     return render(request, 'gametracker/person_detail.html', {'person': person, 'victories': n_victories,
                                                               'defeats': n_defeats, 'ratio': victory_ratio,
-                                                              'elos': elos, 'games': games})
+                                                              'games': games})
 
 
-def game_detail(request, pk):
-    """Detailed view of a game"""
-    game = get_object_or_404(Game, pk=pk)
+def person_elo_json(request, person_name):
+    """
+    Elo history of a person, between the optional 'start' and 'end' dates (included), downsampled to at most
+    'points' points. Each point is the number of the game, its date (null for the initial elo) and the elo.
+    """
+    person = get_object_or_404(Person, name__iexact=person_name)
 
     try:
-        new_elolog = EloLog.objects.filter(date=game.date)[0]
-        old_elolog = EloLog.objects.filter(date__lt=game.date, person=new_elolog.person).latest('date')
-        var_elo = abs(old_elolog.elo - new_elolog.elo)
-    except:
-        var_elo = None
+        n_points = min(max(int(request.GET.get('points', ELO_SERIES_POINTS)), 3), MAX_ELO_SERIES_POINTS)
+        start, end = (parse_date(request.GET[key]) if request.GET.get(key) else False for key in ('start', 'end'))
+        if start is None or end is None:
+            raise ValueError
+    except ValueError:
+        return JsonResponse({'error': "Paramètres invalides"}, status=400)
+
+    history = EloLog.objects.filter(person=person)
+    first_game = 0
+    if start:
+        # Games are numbered from the beginning of the history
+        first_game = history.filter(date__lt=start).count()
+        history = history.filter(date__gte=start)
+    if end:
+        history = history.filter(date__lt=end + timedelta(days=1))
+
+    series = [(game, date, elo) for game, (date, elo)
+              in enumerate(history.order_by('date', 'pk').values_list('date', 'elo'), first_game)]
+
+    indexes = downsample([game for game, date, elo in series], [elo for game, date, elo in series], n_points)
+    points = [series[i] for i in indexes]
+
+    return JsonResponse({'count': len(series),
+                         'points': [{'game': game, 'date': None if date == datetime.min else date.isoformat(),
+                                     'elo': elo} for game, date, elo in points]})
+
+
+def game_detail(request, pk):
+    """Detailed view of a game, with the result of each person stored by the elo update"""
+    players = Player.objects.select_related('identity__person')
+    game = get_object_or_404(Game.objects.select_related('game_map', 'replay')
+                                         .prefetch_related(Prefetch('team1', queryset=players),
+                                                           Prefetch('team2', queryset=players),
+                                                           Prefetch('gameplayer_set', to_attr='results')), pk=pk)
+
+    results = {result.person_id: result for result in game.results}
+    winners, losers = list(game.winners()), list(game.losers())
+
+    # Elo before and after the game, and probability of winning, of the players who have a person
+    for player in winners + losers:
+        player.result = results.get(player.identity.person_id) if player.identity else None
+
+    def win_probability(team):
+        result = next((player.result for player in team if player.result), None)
+        if result is None or result.win_probability is None:
+            return None
+        return result.win_probability * 100
+
     return render(request, 'gametracker/game_detail.html', {'game': game,
                                                             'game_replay': game.replay,
-                                                            'winners': game.winners(),
-                                                            'losers': game.losers(),
-                                                            'var_elo': var_elo})
+                                                            'winners': winners,
+                                                            'losers': losers,
+                                                            'pw_winners': win_probability(winners),
+                                                            'pw_losers': win_probability(losers)})
 
 
 def add_game(request):
     replay_form = ReplayForm(request.POST, request.FILES)
 
     if replay_form.is_valid():
+        # Replays already uploaded are not analyzed again
+        sha256 = uploaded_file_sha256(request, 'replay')
+        known_replay = GameReplay.objects.filter(sha256=sha256).first()
+
+        if known_replay is not None:
+            return redirect_to_replay(known_replay)
+
         replay = replay_form.save(commit=False)
-        replay.save()
+        replay.sha256 = sha256
 
         try:
-            game_id = Game.objects.get(replay=replay).id
-            return redirect(reverse('gametracker:game', kwargs={'pk': game_id}))
-        except:
-            return redirect(reverse('gametracker:duplicated_game'))
+            with transaction.atomic():
+                replay.save()
+        except IntegrityError:
+            # Same replay uploaded at the same time
+            replay.replay.delete(save=False)
+            return redirect_to_replay(GameReplay.objects.get(sha256=sha256))
+
+        # The replay is analyzed in the background
+        job = ReplayJob.objects.get(replay=replay)
+        return redirect(reverse('gametracker:replay_job', kwargs={'pk': job.pk}))
 
     return render(request, 'gametracker/add_game.html', {'form': ReplayForm()})
 
 
+def redirect_to_replay(replay):
+    """Redirect to the game of a replay, or to its analysis if the game is not ready yet"""
+    game = Game.objects.filter(replay=replay).first()
+    if game is not None:
+        return redirect(reverse('gametracker:game', kwargs={'pk': game.pk}))
+
+    job = ReplayJob.objects.filter(replay=replay).first()
+    if job is not None:
+        return redirect(reverse('gametracker:replay_job', kwargs={'pk': job.pk}))
+
+    return redirect(reverse('gametracker:duplicated_game'))
+
+
+def replay_job(request, pk):
+    """Wait for the analysis of a replay, then redirect to the game"""
+    job = get_object_or_404(ReplayJob, pk=pk)
+
+    if job.status == ReplayJob.DONE:
+        # The game may have been deleted since
+        if job.game_id is None:
+            raise Http404("Partie supprimée")
+        return redirect(reverse('gametracker:game', kwargs={'pk': job.game_id}))
+    elif job.status == ReplayJob.DUPLICATE:
+        return redirect(reverse('gametracker:duplicated_game'))
+
+    return render(request, 'gametracker/replay_job.html', {'job': job})
+
+
 def duplicated_game(request):
     return render(request, 'gametracker/duplicated_game.html')
 
@@ -103,12 +334,14 @@ def manually_add_game(request):
         game_form = GameForm(request.POST)
 
         if game_form.is_valid():
-            game = game_form.save(commit=False)
-            game.date = timezone.now()
-            game.save()
-
-            game_form.save_m2m()
-            update_elo(game.date)
+            with deferred_elo_update():
+                game = game_form.save(commit=False)
+                game.date = timezone.now()
+                game.save()
+
+                game_form.save_m2m()
+                add_game_stats(game)
+                request_elo_update(game.date)
             return redirect(reverse('gametracker:history'))
 
     return render(request, 'gametracker/manually_add_game.html', {'form': GameForm})
@@ -120,8 +353,7 @@ def build_orders(request):
 
 def update(request):
     update_elo()
-    persons = Person.objects.order_by('-elo')
-    return render(request, "gametracker/index.html", {'person_list': persons})
+    return render(request, "gametracker/index.html", leaderboard_context(request))
 
 
 def balance_teams(request):
@@ -129,45 +361,131 @@ def balance_teams(request):
         form = TeamsForm(request.POST)
 
         if form.is_valid() and len(form.cleaned_data["players"]) > 1:
-            team_balancer = TeamBalancer(form.cleaned_data["players"])
+            players = sorted(form.cleaned_data["players"], key=lambda player: player.pk)
+            n_matches = form.cleaned_data.get("n_matches") or 1
+            constraints = form.constraints()
+
+            # The same roster is often balanced several times in a row: results are kept until ratings change
+            options = {'n_matches': n_matches, 'constraints': constraint_options(constraints)}
+            result = balancing_cache().get_or_compute([player.pk for player in players], options,
+                                                      lambda: balance_players(players, n_matches, constraints))
+
+            if 'matches' in result:
+                matches = []
+                for indexes1, indexes2 in result['matches']:
+                    team1 = [players[i] for i in indexes1]
+                    team2 = [players[i] for i in indexes2]
+                    pw = prob_winning(calc_team_elo(team1) - calc_team_elo(team2)) * 100
+                    matches.append({'team1': team1, 'team2': team2, 'pw_team1': pw, 'pw_team2': 100 - pw})
+
+                return render(request, "gametracker/balance_teams.html",
+                              {'form': form, 'matches': matches, 'gap': result['gap']})
+
+            splits = result['splits']
+            if not splits:
+                form.add_error(None, "Aucune composition ne respecte ces contraintes")
+                return render(request, "gametracker/balance_teams.html", {'form': form})
+
+            # Alternatives are shown later without searching again
+            request.session['balanced_teams'] = {'players': [player.pk for player in players], 'splits': splits}
+
+            context = teams_context(players, splits, 0)
+            context['form'] = form
+
+            # Teams of the same size are only proposed without constraints
+            if result['equal_split'] is not None:
+                teams_eq = teams_context(players, [result['equal_split']], 0)
+                if set(teams_eq['team1']) not in (set(context['team1']), set(context['team2'])):
+                    context.update({'team1eq': teams_eq['team1'], 'team2eq': teams_eq['team2'],
+                                    'pw_team1eq': teams_eq['pw_team1'],
+                                    'pw_team2eq': teams_eq['pw_team2']})
+
+            context['balance_distribution'] = result['distribution']
 
-            teams = team_balancer.get_teams()
-            context = {'form': form}
-            context.update({'team1': teams[0], 'team2': teams[1],
-                            'elo_team1': calc_team_elo(teams[0]),
-                            'elo_team2': calc_team_elo(teams[1])})
-
-            teams_eq = team_balancer.get_balanced_teams()
-
-            if teams_eq[0] not in teams:
-
-                delta_elo = calc_team_elo(teams_eq[0]) - calc_team_elo(teams_eq[1])
-                pw = prob_winning(delta_elo) * 100
-
-                context.update({'team1eq': teams_eq[0], 'team2eq': teams_eq[1],
-                                'pw_team1eq': pw,
-                                'pw_team2eq': 100-pw})
-            else:
-                context.update({'team1eq': None, 'team2eq': None})
+            return render(request, "gametracker/balance_teams.html", context)
+        else:
+            return render(request, "gametracker/balance_teams.html", {'form': form})
 
-            # Add winning probability for teams
-            delta_elo = calc_team_elo(teams[0]) - calc_team_elo(teams[1])
-            pw = prob_winning(delta_elo) * 100
+    elif 'alternative' in request.GET and 'balanced_teams' in request.session:
+        balanced_teams = request.session['balanced_teams']
+        persons = Person.objects.in_bulk(balanced_teams['players'])
 
-            if pw > 60 or pw < 40:
-                color_cls = "is-danger"
-            elif pw > 55 or pw < 45:
-                color_cls = "is-warning"
-            else:
-                color_cls = "is-success"
+        try:
+            players = [persons[pk] for pk in balanced_teams['players']]
+            alternative = int(request.GET['alternative']) % len(balanced_teams['splits'])
+        except (KeyError, ValueError):
+            return redirect(reverse('gametracker:balance_teams'))
 
-            context.update({"pw_team1": pw,
-                            "pw_team2": 100 - pw,
-                            "color_cls": color_cls})
+        context = teams_context(players, balanced_teams['splits'], alternative)
+        context['form'] = TeamsForm(initial={'players': balanced_teams['players']})
+        return render(request, "gametracker/balance_teams.html", context)
 
-            return render(request, "gametracker/balance_teams.html", context)
-        else:
-            return render(request, "gametracker/balance_teams.html", {'form': form})
     else:
         form = TeamsForm()
         return render(request, "gametracker/balance_teams.html", {'form': form, 'team1': None, 'team2': None})
+
+
+def constraint_options(constraints):
+    """Constraints of the team balancing, with the persons given by their pk"""
+    return {'together': sorted(sorted(person.pk for person in pair) for pair in constraints.get('together', ())),
+            'apart': sorted(sorted(person.pk for person in pair) for pair in constraints.get('apart', ())),
+            'pinned': sorted((person.pk, side) for person, side in constraints.get('pinned', {}).items()),
+            'sizes': constraints.get('sizes')}
+
+
+def balance_players(players, n_matches, constraints):
+    """
+    Balance teams, or several matches, and return the result with the players given by their index,
+    so that it can be cached
+    """
+    if n_matches > 1:
+        # Several matches at the same time are balanced with a heuristic search
+        index = {player.pk: i for i, player in enumerate(players)}
+        balancing = MultiTeamBalancer(players).balance_matches(n_matches)
+        return {'matches': [([index[player.pk] for player in team1], [index[player.pk] for player in team2])
+                            for team1, team2 in balancing.teams],
+                'gap': balancing.gap}
+
+    team_balancer = TeamBalancer(players)
+
+    # The best teams and their alternatives come from a single search
+    if constraints:
+        splits = team_balancer.best_constrained_splits(N_ALTERNATIVES, **constraints)
+        return {'splits': [list(indexes) for delta, indexes in splits], 'equal_split': None, 'distribution': None}
+
+    splits = [list(indexes) for delta, indexes in team_balancer.best_splits(N_ALTERNATIVES)]
+    equal_split = next((indexes for indexes in splits if len(indexes) == len(players) // 2), None)
+    if equal_split is None:
+        equal_split = list(next(team_balancer.best_splits(1, [len(players) // 2]))[1])
+
+    return {'splits': splits, 'equal_split': equal_split, 'distribution': team_balancer.balance_distribution()}
+
+
+def teams_context(players, splits, alternative):
+    """Context showing the teams of an alternative, given by the indexes of the players of the first team"""
+    indexes = set(splits[alternative])
+    team1 = [player for i, player in enumerate(players) if i in indexes]
+    team2 = [player for i, player in enumerate(players) if i not in indexes]
+
+    # Add winning probability for teams
+    delta_elo = calc_team_elo(team1) - calc_team_elo(team2)
+    pw = prob_winning(delta_elo) * 100
+
+    if pw > 60 or pw < 40:
+        color_cls = "is-danger"
+    elif pw > 55 or pw < 45:
+        color_cls = "is-warning"
+    else:
+        color_cls = "is-success"
+
+    return {'team1': team1, 'team2': team2,
+            'elo_team1': calc_team_elo(team1),
+            'elo_team2': calc_team_elo(team2),
+            'team1eq': None, 'team2eq': None,
+            'pw_team1': pw,
+            'pw_team2': 100 - pw,
+            'color_cls': color_cls,
+            'alternative': alternative,
+            'n_alternatives': len(splits),
+            'previous_alternative': (alternative - 1) % len(splits),
+            'next_alternative': (alternative + 1) % len(splits)}
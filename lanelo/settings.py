@@ -198,6 +198,33 @@ MEDIA_URL = '/media/'
 
 FILE_UPLOAD_PERMISSIONS = 0o644
 
+# Replay parser processes, kept alive between replays
+GAMETRACKER_REPLAY_PARSER = {
+    'BACKEND': 'gametracker.parsers.PyRecAnalystParser',
+    'WORKERS': 2,
+    'TIMEOUT': 120,
+    'OPTIONS': {'script': '/home/yoann/software/pyrecanalyst/examples/analyze.py'},
+}
+
+# Parser output and images of the replays, reused when a replay is analyzed again
+GAMETRACKER_REPLAY_CACHE = {
+    'DIRECTORY': os.path.join(BASE_DIR, "replay_cache"),
+    'MAX_SIZE': 512 * 1024 * 1024,
+}
+
+# Team balancing results, kept in each process and in the Django cache until ratings change
+GAMETRACKER_BALANCING_CACHE = {
+    'MAX_SIZE': 128,
+    'TIMEOUT': 24 * 3600,
+}
+
+# Replays are hashed while they are uploaded, to detect duplicates before analyzing them
+FILE_UPLOAD_HANDLERS = [
+    'gametracker.uploadhandlers.HashingUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 def custom_show_toolbar(request):
     return True # Always show toolbar, for example purposes only.
 